@@ -35,3 +35,10 @@ class ChapterAdmin(admin.ModelAdmin):
 
 
 admin.site.register(models.Chapter, ChapterAdmin)
+
+
+class OutgoingEmailAdmin(admin.ModelAdmin):
+    list_display = ["subject", "to", "created", "attempts", "sent"]
+
+
+admin.site.register(models.OutgoingEmail, OutgoingEmailAdmin)
@@ -1,11 +1,126 @@
-from django.core.mail import send_mail
+import logging
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone, translation
+from django.utils.html import escape
 from django.utils.translation import gettext as _
 
 from base.html_email import html_email
+from .models import OutgoingEmail
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait before retrying to send an email. The wait doubles with
+# every failed attempt.
+RETRY_DELAY = 60
+# Seconds that a worker has to send the emails it has claimed.
+SEND_LEASE = 10 * 60
+
+
+def queue_mails(emails):
+    # Store the emails in the outbox. They are sent by the send_book_emails
+    # command once the current transaction has been committed.
+    OutgoingEmail.objects.bulk_create(emails)
+
+
+def claim_queued_mails(batch_size, max_attempts):
+    # Lease a batch of the emails that are due to the current worker. The
+    # next attempt is moved past the lease, so that other workers skip the
+    # emails while they are sent outside of the transaction. If the worker
+    # dies, the emails are tried again after the lease has run out.
+    with transaction.atomic():
+        emails = list(
+            OutgoingEmail.objects.select_for_update(skip_locked=True)
+            .filter(
+                sent=None,
+                next_attempt__lte=timezone.now(),
+                attempts__lt=max_attempts,
+            )
+            .order_by("next_attempt", "id")[:batch_size]
+        )
+        if emails:
+            OutgoingEmail.objects.filter(
+                id__in=[email.id for email in emails]
+            ).update(
+                attempts=F("attempts") + 1,
+                next_attempt=timezone.now() + timedelta(seconds=SEND_LEASE),
+            )
+    for email in emails:
+        email.attempts += 1
+    return emails
+
+
+def send_queued_mails(batch_size=100, max_attempts=5):
+    # Send a batch of the emails in the outbox that are due over a single
+    # connection to the mail server. Returns the number of emails that were
+    # sent and that failed.
+    sent = failed = 0
+    emails = claim_queued_mails(batch_size, max_attempts)
+    if not emails:
+        return sent, failed
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as error:
+        logger.warning(f"Could not connect to mail server: {error}")
+        connection = None
+    for email in emails:
+        try:
+            if not connection:
+                raise ConnectionError("No connection to mail server")
+            message = EmailMultiAlternatives(
+                email.subject,
+                email.message,
+                email.from_email,
+                [email.to],
+                connection=connection,
+            )
+            if email.html_message:
+                message.attach_alternative(email.html_message, "text/html")
+            message.send()
+        except Exception as error:
+            email.next_attempt = timezone.now() + timedelta(
+                seconds=RETRY_DELAY * 2 ** (email.attempts - 1)
+            )
+            email.last_error = str(error)
+            failed += 1
+            if email.attempts >= max_attempts:
+                logger.error(
+                    f"Giving up on email {email.id} to {email.to} after "
+                    f"{email.attempts} attempts: {error}"
+                )
+        else:
+            email.sent = timezone.now()
+            sent += 1
+    if connection:
+        connection.close()
+    OutgoingEmail.objects.bulk_update(
+        emails, ["next_attempt", "sent", "last_error"]
+    )
+    return sent, failed
 
 
-def send_share_notification(
+def send_all_queued_mails(batch_size=100, max_attempts=5):
+    # Send batches of emails until no more emails are due. Returns the number
+    # of emails that were sent and failed and the number of seconds it took.
+    start = time.monotonic()
+    total_sent = total_failed = 0
+    while True:
+        sent, failed = send_queued_mails(batch_size, max_attempts)
+        total_sent += sent
+        total_failed += failed
+        if sent + failed < batch_size:
+            break
+    return total_sent, total_failed, time.monotonic() - start
+
+
+def share_notification_email(
     book_title,
     owner,
     link,
@@ -105,11 +220,142 @@ def send_share_notification(
         "link": link,
         "AccessBooks": _("Access books"),
     }
-    send_mail(
-        _("Book shared: %(book_title)s") % {"book_title": book_title},
-        message_text,
-        settings.DEFAULT_FROM_EMAIL,
-        [collaborator_email],
-        fail_silently=True,
+    return OutgoingEmail(
+        subject=_("Book shared: %(book_title)s") % {"book_title": book_title},
+        message=message_text,
+        html_message=html_email(body_html),
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=collaborator_email,
+    )
+
+
+def share_notification_emails(owner, link, notifications):
+    # Combine the notifications about shared books into one email per
+    # collaborator. notifications is a list of (book, collaborator, rights,
+    # change) tuples. Emails are written in the language of the collaborator
+    # and the list of books is only rendered once for each language.
+    shares = defaultdict(list)
+    collaborators = {}
+    for book, collaborator, rights, change in notifications:
+        collaborators[collaborator.id] = collaborator
+        shares[collaborator.id].append((book.title, rights, change))
+    book_lists = {}
+    emails = []
+    for collaborator_id, collaborator_shares in shares.items():
+        collaborator = collaborators[collaborator_id]
+        language = collaborator.language or translation.get_language()
+        with translation.override(language):
+            if len(collaborator_shares) == 1:
+                book_title, rights, change = collaborator_shares[0]
+                emails.append(
+                    share_notification_email(
+                        book_title,
+                        owner,
+                        link,
+                        collaborator.readable_name,
+                        collaborator.email,
+                        rights,
+                        change,
+                    )
+                )
+                continue
+            key = (language, tuple(collaborator_shares))
+            if key not in book_lists:
+                book_lists[key] = render_book_list(collaborator_shares)
+            emails.append(
+                share_digest_email(
+                    owner,
+                    link,
+                    collaborator.readable_name,
+                    collaborator.email,
+                    *book_lists[key],
+                )
+            )
+    return emails
+
+
+def render_book_list(shares):
+    # Render the list of shared books of a digest as text and as html.
+    message_text = ""
+    body_html = (
+        "<table><tr><th>%(Book)s</th><th>%(AccessRights)s</th></tr>"
+        % {
+            "Book": _("Book"),
+            "AccessRights": _("Access Rights"),
+        }
+    )
+    for book_title, rights, change in shares:
+        if len(book_title) == 0:
+            book_title = _("Untitled")
+        if change:
+            status = _("changed")
+        else:
+            status = _("shared")
+        message_text += "- '%(book_title)s': %(rights)s (%(status)s)\n" % {
+            "book_title": book_title,
+            "rights": rights,
+            "status": status,
+        }
+        body_html += (
+            "<tr><td><b>%(book_title)s</b></td>"
+            "<td>%(rights)s (%(status)s)</td></tr>"
+        ) % {
+            "book_title": escape(book_title),
+            "rights": rights,
+            "status": status,
+        }
+    body_html += "</table>"
+    return message_text, body_html
+
+
+def share_digest_email(
+    owner,
+    link,
+    collaborator_name,
+    collaborator_email,
+    book_list_text,
+    book_list_html,
+):
+    message_text = _(
+        (
+            "Hey %(collaborator_name)s,\n%(owner)s has shared books with "
+            "you or changed your access rights to them:\n\n%(books)s"
+            "\nSee books: %(link)s"
+        )
+    ) % {
+        "owner": owner,
+        "collaborator_name": collaborator_name,
+        "books": book_list_text,
+        "link": link,
+    }
+    body_html = (
+        "<h1>%(Books)s %(shared)s</h1>"
+        "%(body_html_intro)s"
+        "%(books)s"
+        '<div class="actions"><a class="button" href="%(link)s">'
+        "%(AccessBooks)s"
+        "</a></div>"
+    ) % {
+        "Books": _("Books"),
+        "shared": _("shared"),
+        "body_html_intro": _(
+            (
+                "<p>Hey %(collaborator_name)s,<br>%(owner)s has shared "
+                "books with you or changed your access rights to them.</p>"
+            )
+        )
+        % {
+            "owner": escape(owner),
+            "collaborator_name": escape(collaborator_name),
+        },
+        "books": book_list_html,
+        "link": link,
+        "AccessBooks": _("Access books"),
+    }
+    return OutgoingEmail(
+        subject=_("Books shared by %(owner)s") % {"owner": owner},
+        message=message_text,
         html_message=html_email(body_html),
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=collaborator_email,
     )
@@ -0,0 +1,601 @@
+import hashlib
+import json
+from collections import defaultdict
+from contextlib import contextmanager
+
+from asgiref.local import Local
+from avatar.models import Avatar
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Q
+
+from document.helpers.serializers import PythonWithURLSerializer
+from document.models import AccessRight
+from usermedia.models import Image
+from .models import (
+    Book,
+    BookAccessRight,
+    BookChange,
+    BookListVersion,
+    BookStyle,
+    BookStylesVersion,
+    BookVisibility,
+)
+
+STYLES_CACHE_KEY = "book_styles_{}"
+PERMISSIONS_CACHE_KEY = "book_permissions_{}"
+
+
+def get_book_user_ids(book_ids):
+    # Find the ids of the users who can see each of the books, i.e. the owner
+    # and all users a book has been shared with.
+    user_ids = defaultdict(set)
+    for book_id, owner_id in Book.objects.filter(id__in=book_ids).values_list(
+        "id", "owner_id"
+    ):
+        user_ids[book_id].add(owner_id)
+    for book_id, holder_id in BookAccessRight.objects.filter(
+        book_id__in=book_ids, holder_type__model="user"
+    ).values_list("book_id", "holder_id"):
+        user_ids[book_id].add(holder_id)
+    return user_ids
+
+
+def get_user_viewer_ids(user_id):
+    # Find the ids of the users whose book list shows the name and avatar of
+    # a user: the user, the contacts of the user and the users who see books
+    # or documents of the user.
+    user_ids = {user_id}
+    user_ids.update(
+        get_user_model()
+        .objects.filter(contacts__id=user_id)
+        .values_list("id", flat=True)
+    )
+    user_ids.update(
+        BookVisibility.objects.filter(book__owner_id=user_id).values_list(
+            "user_id", flat=True
+        )
+    )
+    user_ids.update(
+        AccessRight.objects.filter(
+            document__owner_id=user_id, holder_type__model="user"
+        ).values_list("holder_id", flat=True)
+    )
+    return user_ids
+
+
+deferred = Local()
+
+
+def get_deferred_changes():
+    return getattr(deferred, "changes", None)
+
+
+@contextmanager
+def defer_book_changes():
+    # Collect the book changes, book list version bumps and book visibility
+    # updates that happen within the block and write them all at once at its
+    # end. This keeps the number of queries constant when many objects with
+    # signal handlers are changed at once.
+    if get_deferred_changes() is not None:
+        # Already deferred by an outer block.
+        yield
+        return
+    changes = {
+        "books": defaultdict(set),
+        "users": set(),
+        "all": False,
+        "visibility": set(),
+        "user_visibility": defaultdict(set),
+    }
+    deferred.changes = changes
+    try:
+        yield
+    finally:
+        deferred.changes = None
+    update_book_visibility(changes["visibility"])
+    update_user_book_visibility(
+        {
+            book_id: book_user_ids
+            for book_id, book_user_ids in changes["user_visibility"].items()
+            if book_id not in changes["visibility"]
+        }
+    )
+    with transaction.atomic(savepoint=False):
+        if changes["all"]:
+            bump_book_list_versions()
+        else:
+            bump_book_list_versions(
+                changes["users"].union(*changes["books"].values())
+            )
+        write_book_changes(changes["books"])
+
+
+def update_book_visibility(book_ids):
+    # Recreate the visibility of the given books for their owners and the
+    # users they are shared with. This is only needed for new books and
+    # changes of the owner, update_user_book_visibility is cheaper otherwise.
+    changes = get_deferred_changes()
+    if changes is not None:
+        changes["visibility"].update(book_ids)
+        return
+    if not book_ids:
+        return
+    BookVisibility.objects.filter(book_id__in=book_ids).delete()
+    create_book_visibility(book_ids)
+
+
+def update_user_book_visibility(user_ids):
+    # Update the visibility of books for some of their users. user_ids maps
+    # book ids to the ids of the users. Only the rows of these users are
+    # written, so the cost does not depend on the number of collaborators.
+    changes = get_deferred_changes()
+    if changes is not None:
+        for book_id, book_user_ids in user_ids.items():
+            changes["user_visibility"][book_id].update(book_user_ids)
+        return
+    user_ids = {
+        book_id: book_user_ids
+        for book_id, book_user_ids in user_ids.items()
+        if book_user_ids
+    }
+    if not user_ids:
+        return
+    clear_book_permissions_cache(user_ids.keys())
+    pairs = Q()
+    for book_id, book_user_ids in user_ids.items():
+        pairs |= Q(book_id=book_id, holder_id__in=book_user_ids)
+    visibilities = {}
+    for book_id, user_id, rights, path in BookAccessRight.objects.filter(
+        pairs,
+        holder_type=ContentType.objects.get_by_natural_key("user", "user"),
+    ).values_list("book_id", "holder_id", "rights", "path"):
+        visibilities[(book_id, user_id)] = BookVisibility(
+            book_id=book_id, user_id=user_id, rights=rights, path=path
+        )
+    for book_id, owner_id, path in Book.objects.filter(
+        id__in=user_ids.keys()
+    ).values_list("id", "owner_id", "path"):
+        if owner_id in user_ids[book_id]:
+            visibilities[(book_id, owner_id)] = BookVisibility(
+                book_id=book_id, user_id=owner_id, rights="write", path=path
+            )
+    removed = Q()
+    for book_id, book_user_ids in user_ids.items():
+        removed_user_ids = {
+            user_id
+            for user_id in book_user_ids
+            if (book_id, user_id) not in visibilities
+        }
+        if removed_user_ids:
+            removed |= Q(book_id=book_id, user_id__in=removed_user_ids)
+    if removed:
+        BookVisibility.objects.filter(removed).delete()
+    if visibilities:
+        # Concurrent updates of the same rows cannot fail, as existing rows
+        # are updated in place.
+        BookVisibility.objects.bulk_create(
+            visibilities.values(),
+            update_conflicts=True,
+            unique_fields=["user", "book"],
+            update_fields=["rights", "path"],
+        )
+
+
+def create_book_visibility(book_ids):
+    clear_book_permissions_cache(book_ids)
+    visibilities = {}
+    for book_id, user_id, rights, path in BookAccessRight.objects.filter(
+        book_id__in=book_ids,
+        holder_type=ContentType.objects.get_by_natural_key("user", "user"),
+    ).values_list("book_id", "holder_id", "rights", "path"):
+        visibilities[(book_id, user_id)] = BookVisibility(
+            book_id=book_id, user_id=user_id, rights=rights, path=path
+        )
+    for book_id, owner_id, path in Book.objects.filter(
+        id__in=book_ids
+    ).values_list("id", "owner_id", "path"):
+        # The owner always has write access.
+        visibilities[(book_id, owner_id)] = BookVisibility(
+            book_id=book_id, user_id=owner_id, rights="write", path=path
+        )
+    BookVisibility.objects.bulk_create(visibilities.values())
+
+
+def rebuild_book_visibility(batch_size=1000):
+    # Recreate the visibility of all books. Returns the number of books.
+    BookVisibility.objects.all().delete()
+    count = 0
+    last_id = 0
+    while True:
+        book_ids = [
+            book_id
+            for book_id in Book.objects.filter(id__gt=last_id)
+            .order_by("id")
+            .values_list("id", flat=True)[:batch_size]
+        ]
+        if not book_ids:
+            break
+        create_book_visibility(book_ids)
+        count += len(book_ids)
+        last_id = book_ids[-1]
+    return count
+
+
+def get_book_permissions(request, book_id):
+    # The owner of a book and the rights of all users who can see it, or None
+    # if the book does not exist. They are looked up once per request and, if
+    # BOOK_PERMISSIONS_CACHE_TIMEOUT is set, kept in the cache across
+    # requests. The cache has to be shared by all processes for that.
+    if not hasattr(request, "book_permissions"):
+        request.book_permissions = {}
+    if book_id in request.book_permissions:
+        return request.book_permissions[book_id]
+    timeout = getattr(settings, "BOOK_PERMISSIONS_CACHE_TIMEOUT", 0)
+    cache_key = PERMISSIONS_CACHE_KEY.format(book_id)
+    permissions = cache.get(cache_key) if timeout else None
+    if permissions is None:
+        permissions = {"owner_id": None, "rights": {}}
+        for user_id, rights, owner_id in BookVisibility.objects.filter(
+            book_id=book_id
+        ).values_list("user_id", "rights", "book__owner_id"):
+            permissions["owner_id"] = owner_id
+            permissions["rights"][user_id] = rights
+        if timeout:
+            cache.set(cache_key, permissions, timeout)
+    if permissions["owner_id"] is None:
+        permissions = None
+    request.book_permissions[book_id] = permissions
+    return permissions
+
+
+def get_book_rights(request, book_id):
+    # The rights of the user of the request on a book, or None if the user
+    # cannot see the book.
+    permissions = get_book_permissions(request, book_id)
+    if not permissions:
+        return None
+    return permissions["rights"].get(request.user.id)
+
+
+def is_book_owner(request, book_id):
+    permissions = get_book_permissions(request, book_id)
+    return bool(permissions) and permissions["owner_id"] == request.user.id
+
+
+def clear_book_permissions_cache(book_ids):
+    keys = [PERMISSIONS_CACHE_KEY.format(book_id) for book_id in book_ids]
+    if not keys:
+        return
+    cache.delete_many(keys)
+    # Other requests may cache the old permissions again until the change
+    # is committed.
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def log_book_changes(user_ids):
+    # Record that books have changed for users. user_ids maps book ids to the
+    # ids of the users for whom the book has changed. The book lists of the
+    # users are marked as changed.
+    changes = get_deferred_changes()
+    if changes is not None:
+        for book_id, book_user_ids in user_ids.items():
+            changes["books"][book_id].update(book_user_ids)
+        return
+    with transaction.atomic(savepoint=False):
+        bump_book_list_versions(set().union(*user_ids.values()))
+        write_book_changes(user_ids)
+
+
+def write_book_changes(user_ids):
+    # The changes are stamped with the book list versions of the users. These
+    # have to be bumped in the same transaction, which keeps their rows
+    # locked until the changes are committed. So once a version can be read,
+    # all changes up to it are visible. Older changes of the same books are
+    # removed, as only the latest one is of interest.
+    all_user_ids = set().union(*user_ids.values())
+    if not all_user_ids:
+        return
+    versions = dict(
+        BookListVersion.objects.filter(user_id__in=all_user_ids).values_list(
+            "user_id", "version"
+        )
+    )
+    old_changes = Q()
+    new_changes = []
+    for book_id, book_user_ids in user_ids.items():
+        if not book_user_ids:
+            continue
+        old_changes |= Q(book_id=book_id, user_id__in=book_user_ids)
+        new_changes += [
+            BookChange(
+                book_id=book_id, user_id=user_id, version=versions[user_id]
+            )
+            for user_id in book_user_ids
+        ]
+    BookChange.objects.filter(old_changes).delete()
+    BookChange.objects.bulk_create(new_changes)
+
+
+def bump_book_list_versions(user_ids=None):
+    # Mark the book lists of the given users as changed. Without user ids, the
+    # book lists of all users are marked as changed.
+    changes = get_deferred_changes()
+    if changes is not None:
+        if user_ids is None:
+            changes["all"] = True
+        else:
+            changes["users"].update(user_ids)
+        return
+    if user_ids is None:
+        BookListVersion.objects.update(version=F("version") + 1)
+        return
+    if not user_ids:
+        return
+    BookListVersion.objects.bulk_create(
+        [BookListVersion(user_id=user_id) for user_id in user_ids],
+        ignore_conflicts=True,
+    )
+    BookListVersion.objects.filter(user_id__in=user_ids).update(
+        version=F("version") + 1
+    )
+
+
+def get_book_list_version(user):
+    version, _created = BookListVersion.objects.get_or_create(user=user)
+    return version.version
+
+
+def get_styles():
+    # The serialized book styles only change when an admin edits them, so
+    # they are cached together with an ETag for them. The cache key contains
+    # the version of the styles in the database, so changes made by other
+    # processes are seen as well.
+    version = (
+        BookStylesVersion.objects.filter(id=1)
+        .values_list("version", flat=True)
+        .first()
+        or 0
+    )
+    cache_key = STYLES_CACHE_KEY.format(version)
+    styles = cache.get(cache_key)
+    if styles is None:
+        serializer = PythonWithURLSerializer()
+        book_styles = serializer.serialize(
+            BookStyle.objects.all(),
+            use_natural_foreign_keys=True,
+            fields=["title", "slug", "contents", "bookstylefile_set"],
+        )
+        styles_list = [obj["fields"] for obj in book_styles]
+        styles = {
+            "styles": styles_list,
+            "etag": hashlib.md5(json.dumps(styles_list).encode()).hexdigest(),
+        }
+        cache.set(cache_key, styles, None)
+    return styles
+
+
+def bump_book_styles_version():
+    BookStylesVersion.objects.bulk_create(
+        [BookStylesVersion(id=1)], ignore_conflicts=True
+    )
+    BookStylesVersion.objects.filter(id=1).update(version=F("version") + 1)
+
+
+def get_holders(access_rights):
+    # Resolve the holders of many access rights with one query per type of
+    # holder. Returns a dict mapping (holder_type_id, holder_id) to holders.
+    holder_ids = defaultdict(set)
+    for access_right in access_rights:
+        holder_ids[access_right.holder_type_id].add(access_right.holder_id)
+    holders = {}
+    for holder_type_id, ids in holder_ids.items():
+        holder_model = ContentType.objects.get_for_id(
+            holder_type_id
+        ).model_class()
+        for holder in holder_model.objects.filter(id__in=ids):
+            holders[(holder_type_id, holder.id)] = holder
+    return holders
+
+
+def prefetch_avatars(avatars, users):
+    # Resolve the avatar URLs of many users with a single query and store
+    # them in the Avatars instance, which otherwise looks them up one user at
+    # a time.
+    size = settings.AVATAR_DEFAULT_SIZE
+    user_ids = {user.id for user in users if user.id not in avatars.AVATARS}
+    if not user_ids:
+        return
+    for user_id in user_ids:
+        avatars.AVATARS[user_id] = None
+    found_user_ids = set()
+    for avatar in (
+        Avatar.objects.filter(user_id__in=user_ids)
+        .select_related("user")
+        .order_by("-primary", "-date_uploaded")
+    ):
+        # The first avatar of each user is the primary or the latest one.
+        if avatar.user_id in found_user_ids:
+            continue
+        found_user_ids.add(avatar.user_id)
+        if not avatar.thumbnail_exists(size, size):
+            avatar.create_thumbnail(size, size)
+        avatars.AVATARS[avatar.user_id] = avatar.avatar_url(size, size)
+
+
+def free_paths(user, paths):
+    # Find a free path for each of the given paths by adding the lowest
+    # counter that is not used by another book of the user. The paths in use
+    # are looked up with one query for all paths.
+    base_paths = {path for path in paths if len(path)}
+    if not base_paths:
+        return paths
+    path_filter = Q()
+    for path in base_paths:
+        path_filter |= Q(path__startswith=path)
+    used_paths = set(
+        Book.objects.filter(path_filter, owner=user)
+        .values_list("path", flat=True)
+        .union(
+            BookAccessRight.objects.filter(
+                path_filter,
+                holder_type=ContentType.objects.get_for_model(user),
+                holder_id=user.id,
+            ).values_list("path", flat=True)
+        )
+    )
+    result = []
+    for path in paths:
+        if len(path):
+            counter = 0
+            base_path = path
+            while path in used_paths:
+                counter += 1
+                path = f"{base_path} {counter}"
+            used_paths.add(path)
+        result.append(path)
+    return result
+
+
+def apply_json_patch(value, operations):
+    # Apply JSON patch (RFC 6902) add, replace and remove operations to a
+    # JSON value and return the result. Invalid operations raise a
+    # ValueError.
+    if not isinstance(operations, list):
+        raise ValueError("JSON patch operations must be a list")
+    for operation in operations:
+        if not isinstance(operation, dict) or not isinstance(
+            operation.get("path", ""), str
+        ):
+            raise ValueError(f"Invalid operation: {operation}")
+        op = operation.get("op")
+        keys = [
+            key.replace("~1", "/").replace("~0", "~")
+            for key in operation.get("path", "").split("/")[1:]
+        ]
+        if op not in ("add", "replace", "remove"):
+            raise ValueError(f"Unsupported operation: {op}")
+        if op != "remove" and "value" not in operation:
+            raise ValueError("Missing value")
+        if not keys:
+            if op == "remove":
+                raise ValueError("Cannot remove the root")
+            value = operation["value"]
+            continue
+        parent = value
+        try:
+            for key in keys[:-1]:
+                parent = parent[int(key) if isinstance(parent, list) else key]
+            key = keys[-1]
+            if isinstance(parent, list):
+                if op == "add" and key == "-":
+                    parent.append(operation["value"])
+                elif op == "add":
+                    if int(key) > len(parent):
+                        raise IndexError(key)
+                    parent.insert(int(key), operation["value"])
+                elif op == "replace":
+                    parent[int(key)] = operation["value"]
+                else:
+                    del parent[int(key)]
+            elif not isinstance(parent, dict):
+                raise ValueError(f"Not a container: {operation['path']}")
+            elif op == "add":
+                parent[key] = operation["value"]
+            elif op == "replace":
+                if key not in parent:
+                    raise KeyError(key)
+                parent[key] = operation["value"]
+            else:
+                del parent[key]
+        except (IndexError, KeyError, TypeError) as error:
+            raise ValueError(f"Invalid path: {operation['path']}") from error
+    return value
+
+
+def check_chapter_operations(operations):
+    # Make sure that the chapter operations of a book patch have the right
+    # shape. Raises a ValueError otherwise.
+    if not isinstance(operations, list):
+        raise ValueError("Chapter operations must be a list")
+    for operation in operations:
+        if not isinstance(operation, dict) or not isinstance(
+            operation.get("text"), int
+        ):
+            raise ValueError(f"Invalid chapter operation: {operation}")
+        if not isinstance(operation.get("number", 0), int) or (
+            operation.get("op") == "add" and "number" not in operation
+        ):
+            raise ValueError(f"Invalid chapter number: {operation}")
+        if not isinstance(operation.get("part", ""), str):
+            raise ValueError(f"Invalid chapter part: {operation}")
+
+
+def check_access_rights(rights):
+    # Make sure that the requested access rights have the right shape and
+    # only name holders that books can be shared with. Raises a ValueError
+    # otherwise.
+    if not isinstance(rights, list):
+        raise ValueError("Access rights must be a list")
+    for right in rights:
+        holder = right.get("holder") if isinstance(right, dict) else None
+        if (
+            not isinstance(holder, dict)
+            or not isinstance(holder.get("id"), int)
+            or holder.get("type") not in ("user", "userinvite")
+        ):
+            raise ValueError(f"Invalid holder: {right}")
+        if right.get("rights") not in ("read", "write", "delete"):
+            raise ValueError(f"Invalid rights: {right}")
+
+
+def check_book_copies(copies):
+    # Make sure that the requested copies of books have the right shape.
+    # Raises a ValueError otherwise.
+    if not isinstance(copies, list):
+        raise ValueError("Copies must be a list")
+    for copy in copies:
+        if (
+            not isinstance(copy, dict)
+            or not isinstance(copy.get("id"), int)
+            or not isinstance(copy.get("path"), str)
+        ):
+            raise ValueError(f"Invalid copy: {copy}")
+
+
+def copy_object(instance, **kwargs):
+    # An unsaved copy of a model instance with some of its fields replaced.
+    values = {
+        field.attname: getattr(instance, field.attname)
+        for field in instance._meta.concrete_fields
+        if not field.primary_key
+    }
+    instance = type(instance)(**values)
+    for name, value in kwargs.items():
+        setattr(instance, name, value)
+    return instance
+
+
+def delete_unused_images(image_ids):
+    # Delete the images that are not referred to by anything anymore. Whether
+    # they are in use is checked with one query for all images.
+    if not image_ids:
+        return
+    unused_images = Image.objects.filter(id__in=image_ids)
+    for relation in Image._meta.get_fields():
+        if (
+            (relation.one_to_many or relation.one_to_one)
+            and relation.auto_created
+            and not relation.concrete
+        ):
+            unused_images = unused_images.filter(
+                ~Exists(
+                    relation.related_model.objects.filter(
+                        **{relation.field.name: OuterRef("pk")}
+                    )
+                )
+            )
+    unused_images.delete()
@@ -0,0 +1,168 @@
+import logging
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from document.models import AccessRight, Document
+from usermedia.models import DocumentImage
+from .helpers import (
+    bump_book_list_versions,
+    copy_object,
+    free_paths,
+)
+from .models import BookCopyJob, BookVisibility, Chapter
+
+logger = logging.getLogger(__name__)
+
+# Number of chapter documents that are copied in one transaction. The
+# progress of a job is updated after each batch.
+COPY_BATCH_SIZE = 10
+
+
+def claim_copy_job():
+    # Mark the oldest pending job as running and return it, so that other
+    # workers do not pick it up as well.
+    with transaction.atomic():
+        job = (
+            BookCopyJob.objects.select_for_update(skip_locked=True)
+            .filter(status="pending")
+            .order_by("id")
+            .first()
+        )
+        if job:
+            job.status = "running"
+            job.save(update_fields=["status", "updated"])
+    return job
+
+
+def run_copy_jobs():
+    # Run pending copy jobs until there are none left. Returns the number of
+    # jobs that were run.
+    count = 0
+    while job := claim_copy_job():
+        try:
+            run_copy_job(job)
+        except Exception:
+            logger.exception(f"Copy job {job.id} failed")
+            job.status = "failed"
+            job.save(update_fields=["status", "updated"])
+        count += 1
+    return count
+
+
+def readable_documents(user, document_ids):
+    # The ids of the documents that the user owns or has been given access
+    # to.
+    return set(
+        Document.objects.filter(id__in=document_ids)
+        .filter(
+            Q(owner=user)
+            | Exists(
+                AccessRight.objects.filter(
+                    document_id=OuterRef("pk"),
+                    holder_type=ContentType.objects.get_for_model(user),
+                    holder_id=user.id,
+                )
+            )
+        )
+        .values_list("id", flat=True)
+    )
+
+
+def run_copy_job(job):
+    # Copy a book with its chapter documents, their images and comments for
+    # the user of the job. The documents are copied in batches and stay
+    # unlisted until the book with all its chapters has been created, so that
+    # a failed job does not leave partial copies in the document overview.
+    # They are removed again if the job fails.
+    book = job.book
+    user = job.user
+    if (
+        not book
+        or not BookVisibility.objects.filter(user=user, book=book).exists()
+    ):
+        # The book was deleted or the user lost access to it before the job
+        # ran.
+        job.status = "failed"
+        job.save(update_fields=["status", "updated"])
+        return
+    chapters = list(book.chapter_set.select_related("text"))
+    # Access to a book does not give access to its chapter documents. Only
+    # the chapters the user can read are copied.
+    text_ids = readable_documents(
+        user, [chapter.text_id for chapter in chapters]
+    )
+    chapters = [chapter for chapter in chapters if chapter.text_id in text_ids]
+    job.chapters_total = len(chapters)
+    job.save(update_fields=["chapters_total", "updated"])
+    new_texts = {}
+    try:
+        copy_book(job, chapters, new_texts)
+    except Exception:
+        # The documents that have been copied so far are unlisted and would
+        # otherwise stay behind unseen.
+        Document.objects.filter(
+            id__in=[text.id for text in new_texts.values()], listed=False
+        ).delete()
+        raise
+
+
+def copy_book(job, chapters, new_texts):
+    # Copy the chapter documents in batches, adding them to new_texts, and
+    # then create the book with the chapters.
+    book = job.book
+    user = job.user
+    for start in range(0, len(chapters), COPY_BATCH_SIZE):
+        batch = chapters[start : start + COPY_BATCH_SIZE]
+        with transaction.atomic():
+            texts = {
+                chapter.text_id: copy_object(
+                    chapter.text, owner=user, path="", listed=False
+                )
+                for chapter in batch
+                if chapter.text_id not in new_texts
+            }
+            Document.objects.bulk_create(texts.values())
+            DocumentImage.objects.bulk_create(
+                [
+                    copy_object(
+                        document_image,
+                        document=texts[document_image.document_id],
+                    )
+                    for document_image in DocumentImage.objects.filter(
+                        document_id__in=texts.keys()
+                    )
+                ]
+            )
+            new_texts.update(texts)
+            job.chapters_copied += len(batch)
+            job.save(update_fields=["chapters_copied", "updated"])
+    with transaction.atomic():
+        path = free_paths(user, [job.path])[0]
+        new_book = copy_object(
+            book, owner=user, path=path, content_updated=timezone.now()
+        )
+        new_book.save()
+        Chapter.objects.bulk_create(
+            [
+                copy_object(
+                    chapter, book=new_book, text=new_texts[chapter.text_id]
+                )
+                for chapter in chapters
+            ]
+        )
+        Document.objects.filter(
+            id__in=[
+                new_texts[chapter.text_id].id
+                for chapter in chapters
+                if chapter.text.listed
+            ]
+        ).update(listed=True)
+        # Bulk operations do not send signals. The new documents are part of
+        # the book list of the user.
+        bump_book_list_versions({user.id})
+        job.new_book = new_book
+        job.status = "finished"
+        job.save(update_fields=["new_book", "status", "updated"])
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from book.helpers import rebuild_book_visibility
+
+
+class Command(BaseCommand):
+    help = (
+        "Recreate the table of the books that users can see from the owners "
+        "and access rights of all books."
+    )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            count = rebuild_book_visibility()
+        self.stdout.write(f"Rebuilt the visibility of {count} books")
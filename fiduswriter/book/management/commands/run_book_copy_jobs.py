@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from book.jobs import run_copy_jobs
+
+
+class Command(BaseCommand):
+    help = (
+        "Copy the books that users have requested to be copied including "
+        "their chapter documents. Runs continuously unless --once is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Run the pending copy jobs and exit.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=5,
+            help="Seconds to wait between checks for new copy jobs.",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            count = run_copy_jobs()
+            if count:
+                self.stdout.write(f"Ran {count} copy jobs")
+            if options["once"]:
+                break
+            time.sleep(options["interval"])
@@ -0,0 +1,52 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from book.emails import send_all_queued_mails
+
+
+class Command(BaseCommand):
+    help = (
+        "Send the emails in the outbox of the book app. Runs continuously "
+        "unless --once is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Send the emails that are due and exit.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=10,
+            help="Seconds to wait between checks for new emails.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Number of emails to send over one connection.",
+        )
+        parser.add_argument(
+            "--max-attempts",
+            type=int,
+            default=5,
+            help="Number of times to try sending an email.",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed, duration = send_all_queued_mails(
+                options["batch_size"], options["max_attempts"]
+            )
+            if sent or failed:
+                rate = sent / duration if duration else sent
+                self.stdout.write(
+                    f"Sent {sent} emails, {failed} failed in "
+                    f"{duration:.2f}s ({rate:.1f} emails/s)"
+                )
+            if options["once"]:
+                break
+            time.sleep(options["interval"])
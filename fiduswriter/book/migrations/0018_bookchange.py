@@ -0,0 +1,43 @@
+# Generated by Django 5.2.9 on 2026-10-18 15:09
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("book", "0017_book_styles"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="BookChange",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                ("book_id", models.PositiveIntegerField()),
+                ("version", models.PositiveIntegerField(default=0)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["user", "version"],
+                        name="book_bookch_user_id_259769_idx",
+                    ),
+                    models.Index(
+                        fields=["book_id", "user"],
+                        name="book_bookch_book_id_2bc251_idx",
+                    ),
+                ],
+            },
+        ),
+    ]
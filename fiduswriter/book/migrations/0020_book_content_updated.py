@@ -0,0 +1,52 @@
+# Generated by Django 5.2.9 on 2026-10-18 15:14
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import Max
+
+BATCH_SIZE = 1000
+
+
+def set_content_updated(apps, schema_editor):
+    Book = apps.get_model("book", "Book")
+    last_id = 0
+    while True:
+        books = [
+            book
+            for book in Book.objects.filter(id__gt=last_id)
+            .order_by("id")
+            .annotate(chapters_updated=Max("chapter__text__updated"))
+            .only("id", "updated")[:BATCH_SIZE]
+        ]
+        if not books:
+            break
+        for book in books:
+            book.content_updated = book.updated
+            if (
+                book.chapters_updated
+                and book.chapters_updated > book.content_updated
+            ):
+                book.content_updated = book.chapters_updated
+        Book.objects.bulk_update(books, ["content_updated"])
+        last_id = books[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("book", "0019_booklistversion"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="book",
+            name="content_updated",
+            field=models.DateTimeField(
+                db_index=True, default=django.utils.timezone.now
+            ),
+        ),
+        migrations.RunPython(
+            set_content_updated,
+            migrations.RunPython.noop,
+        ),
+    ]
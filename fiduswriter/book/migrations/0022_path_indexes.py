@@ -0,0 +1,26 @@
+# Generated by Django 5.2.9 on 2026-10-18 15:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("book", "0021_outgoingemail"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="book",
+            index=models.Index(
+                fields=["owner", "path"], name="book_book_owner_i_f4767b_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="bookaccessright",
+            index=models.Index(
+                fields=["holder_type", "holder_id", "path"],
+                name="book_bookac_holder__f7ca1b_idx",
+            ),
+        ),
+    ]
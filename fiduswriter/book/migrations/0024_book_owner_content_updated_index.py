@@ -0,0 +1,20 @@
+# Generated by Django 5.2.9 on 2026-10-18 15:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("book", "0023_bookcopyjob"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="book",
+            index=models.Index(
+                fields=["owner", "content_updated"],
+                name="book_book_owner_i_9d1c37_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,92 @@
+# Generated by Django 5.2.9 on 2026-10-18 15:49
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def create_book_visibility(apps, schema_editor):
+    Book = apps.get_model("book", "Book")
+    BookAccessRight = apps.get_model("book", "BookAccessRight")
+    BookVisibility = apps.get_model("book", "BookVisibility")
+    last_id = 0
+    while True:
+        books = [
+            book
+            for book in Book.objects.filter(id__gt=last_id)
+            .order_by("id")
+            .values_list("id", "owner_id", "path")[:BATCH_SIZE]
+        ]
+        if not books:
+            break
+        visibilities = {}
+        for book_id, user_id, rights, path in BookAccessRight.objects.filter(
+            book_id__in=[book[0] for book in books],
+            holder_type__app_label="user",
+            holder_type__model="user",
+        ).values_list("book_id", "holder_id", "rights", "path"):
+            visibilities[(book_id, user_id)] = BookVisibility(
+                book_id=book_id, user_id=user_id, rights=rights, path=path
+            )
+        for book_id, owner_id, path in books:
+            visibilities[(book_id, owner_id)] = BookVisibility(
+                book_id=book_id, user_id=owner_id, rights="write", path=path
+            )
+        BookVisibility.objects.bulk_create(visibilities.values())
+        last_id = books[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("book", "0024_book_owner_content_updated_index"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="BookVisibility",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "rights",
+                    models.CharField(
+                        choices=[("read", "Reader"), ("write", "Writer")],
+                        max_length=5,
+                    ),
+                ),
+                ("path", models.TextField(blank=True, default="")),
+                (
+                    "book",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="book.book",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("user", "book")},
+            },
+        ),
+        migrations.RunPython(
+            create_book_visibility,
+            migrations.RunPython.noop,
+        ),
+    ]
@@ -1,3 +1,6 @@
+import hashlib
+import json
+
 from django.db import models
 from django.utils import timezone
 from django.conf import settings as django_settings
@@ -39,6 +42,17 @@ class Book(models.Model):
     )
     added = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now_add=True)
+    # The latest time the book or any of its chapter documents was updated.
+    content_updated = models.DateTimeField(default=timezone.now, db_index=True)
+    # Increased with every save of the book through the API, so that saves
+    # based on an outdated version can be detected.
+    version = models.PositiveIntegerField(default=1)
+
+    class Meta(object):
+        indexes = [
+            models.Index(fields=["owner", "path"]),
+            models.Index(fields=["owner", "content_updated"]),
+        ]
 
     def __str__(self):
         return self.title
@@ -46,27 +60,94 @@ class Book(models.Model):
     @classmethod
     def from_db(cls, db, field_names, values):
         instance = super().from_db(db, field_names, values)
-        instance._loaded_values = dict(zip(field_names, values))
+        instance.remember_fields(field_names)
         return instance
 
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        super().refresh_from_db(
+            using=using, fields=fields, from_queryset=from_queryset
+        )
+        self.remember_fields(
+            [self._meta.get_field(name).attname for name in fields]
+            if fields
+            else [field.attname for field in self._meta.concrete_fields]
+        )
+
+    def field_fingerprint(self, field):
+        # A compact value to compare the field with. JSON is hashed so that
+        # large metadata and settings do not have to be kept in memory twice.
+        value = getattr(self, field.attname)
+        if isinstance(field, models.JSONField):
+            return hashlib.sha1(
+                json.dumps(value, sort_keys=True).encode()
+            ).digest()
+        if isinstance(field, models.FileField):
+            return value.name
+        return value
+
+    def remember_fields(self, attnames):
+        # Remember the state of the given fields as saved in the database.
+        if not hasattr(self, "_fingerprints"):
+            self._fingerprints = {}
+        deferred_fields = self.get_deferred_fields()
+        for field in self._meta.concrete_fields:
+            if (
+                field.attname in attnames
+                and field.attname not in deferred_fields
+            ):
+                self._fingerprints[field.attname] = self.field_fingerprint(
+                    field
+                )
+
+    def dirty_fields(self):
+        # The fields that differ from the database. Fields that have not been
+        # loaded are not dirty, unless they have been set.
+        fingerprints = getattr(self, "_fingerprints", {})
+        deferred_fields = self.get_deferred_fields()
+        return [
+            field.attname
+            for field in self._meta.concrete_fields
+            if not field.primary_key
+            and field.attname not in deferred_fields
+            and (
+                field.attname not in fingerprints
+                or fingerprints[field.attname] != self.field_fingerprint(field)
+            )
+        ]
+
     def has_changed(self):
-        if (
-            self._loaded_values["title"] != self.title
-            or self._loaded_values["metadata"] != self.metadata
-            or self._loaded_values["settings"] != self.settings
-            or self._loaded_values["cover_image_id"] != self.cover_image_id
-            or self._loaded_values["owner_id"] != self.owner_id
-        ):
-            return True
-        else:
-            return False
+        return bool(
+            {"title", "metadata", "settings", "cover_image_id", "owner_id"}
+            & set(self.dirty_fields())
+        )
 
     def save(self, *args, **kwargs):
         if ("force_update" in kwargs and kwargs["force_update"]) or (
             not self._state.adding and self.has_changed()
         ):
             self.updated = timezone.now()
-        return super().save(*args, **kwargs)
+            self.content_updated = self.updated
+        if (
+            not self._state.adding
+            and self.pk is not None
+            and not args
+            and kwargs.get("update_fields") is None
+            and not kwargs.get("force_insert")
+        ):
+            # Only write the fields that have changed. Nothing is saved if
+            # none have.
+            kwargs["update_fields"] = self.dirty_fields()
+        result = super().save(*args, **kwargs)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None:
+            self.remember_fields(
+                [field.attname for field in self._meta.concrete_fields]
+            )
+        else:
+            self.remember_fields(
+                [self._meta.get_field(name).attname for name in update_fields]
+            )
+        return result
 
 
 class Chapter(models.Model):
@@ -99,6 +180,9 @@ class BookAccessRight(models.Model):
 
     class Meta(object):
         unique_together = (("book", "holder_id", "holder_type"),)
+        indexes = [
+            models.Index(fields=["holder_type", "holder_id", "path"]),
+        ]
 
     def __str__(self):
         if self.holder_obj:
@@ -107,6 +191,142 @@ class BookAccessRight(models.Model):
             return f"{self.holder_type.model} {self.holder_id} {self.rights} on {self.book.title}"
 
 
+class BookVisibility(models.Model):
+    # The books a user can see, with the rights and the path of the user for
+    # each of them. It combines the owners of books and their access rights
+    # for users, so that permissions and paths can be found with a single
+    # lookup. Maintained by signal handlers; rebuild it with the
+    # rebuild_book_visibility command.
+    user = models.ForeignKey(
+        django_settings.AUTH_USER_MODEL, on_delete=models.deletion.CASCADE
+    )
+    book = models.ForeignKey(Book, on_delete=models.deletion.CASCADE)
+    rights = models.CharField(max_length=5, choices=RIGHTS_CHOICES)
+    path = models.TextField(default="", blank=True)
+
+    class Meta(object):
+        unique_together = (("user", "book"),)
+
+    def __str__(self):
+        return f"{self.user} {self.rights} on {self.book_id}"
+
+
+class BookChange(models.Model):
+    # A log of the books that have changed for a user. It allows the book
+    # overview to only download the books that changed since its last visit.
+    # Each change is stamped with the version of the book list of the user
+    # it was recorded in. Only the latest change of each book is kept.
+    id = models.BigAutoField(primary_key=True)
+    user = models.ForeignKey(
+        django_settings.AUTH_USER_MODEL, on_delete=models.deletion.CASCADE
+    )
+    # Not a foreign key as the book may have been deleted.
+    book_id = models.PositiveIntegerField()
+    version = models.PositiveIntegerField(default=0)
+
+    class Meta(object):
+        indexes = [
+            models.Index(fields=["user", "version"]),
+            models.Index(fields=["book_id", "user"]),
+        ]
+
+    def __str__(self):
+        return f"Book {self.book_id} changed for {self.user}"
+
+
+class BookListVersion(models.Model):
+    # A version of all the data in the book list of a user. It is increased
+    # whenever any of the data changes, which allows the list to be served
+    # with an ETag that is cheap to compute.
+    user = models.OneToOneField(
+        django_settings.AUTH_USER_MODEL,
+        on_delete=models.deletion.CASCADE,
+        primary_key=True,
+    )
+    version = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"Version {self.version} of book list of {self.user}"
+
+
+class BookStylesVersion(models.Model):
+    # The version of all book styles, kept in a single row. It is increased
+    # whenever a style or style file changes, so that all processes can tell
+    # whether their cached styles are current.
+    version = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"Version {self.version} of book styles"
+
+
+COPY_JOB_STATUS_CHOICES = (
+    ("pending", "Pending"),
+    ("running", "Running"),
+    ("finished", "Finished"),
+    ("failed", "Failed"),
+)
+
+
+class BookCopyJob(models.Model):
+    # A request to copy a book including its chapter documents. Copying a
+    # large book takes time, so it is done by the run_book_copy_jobs command
+    # instead of within the request.
+    user = models.ForeignKey(
+        django_settings.AUTH_USER_MODEL, on_delete=models.deletion.CASCADE
+    )
+    book = models.ForeignKey(
+        Book, null=True, on_delete=models.deletion.SET_NULL
+    )
+    path = models.TextField(default="", blank=True)
+    status = models.CharField(
+        max_length=8, choices=COPY_JOB_STATUS_CHOICES, default="pending"
+    )
+    chapters_total = models.PositiveIntegerField(default=0)
+    chapters_copied = models.PositiveIntegerField(default=0)
+    new_book = models.ForeignKey(
+        Book,
+        null=True,
+        blank=True,
+        related_name="+",
+        on_delete=models.deletion.SET_NULL,
+    )
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta(object):
+        indexes = [
+            models.Index(fields=["status", "id"]),
+        ]
+
+    def __str__(self):
+        return f"Copy of book {self.book_id} for {self.user} ({self.status})"
+
+
+class OutgoingEmail(models.Model):
+    # An email that is waiting to be sent. Emails are written to this outbox
+    # as part of the transaction of a request and sent afterward by the
+    # send_book_emails command, so that a slow mail server does not hold up
+    # requests.
+    subject = models.CharField(max_length=255)
+    message = models.TextField()
+    html_message = models.TextField(blank=True, default="")
+    from_email = models.CharField(max_length=255)
+    to = models.EmailField()
+    created = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    sent = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default="")
+
+    class Meta(object):
+        indexes = [
+            models.Index(fields=["sent", "next_attempt"]),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} to {self.to}"
+
+
 class BookStyle(models.Model):
     title = models.CharField(
         max_length=128,
@@ -1,8 +1,32 @@
-from django.db.models.signals import pre_delete
+from collections import defaultdict
+
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import F, QuerySet
+from django.db.models.signals import (
+    m2m_changed,
+    pre_delete,
+    pre_save,
+    post_delete,
+    post_save,
+)
 from django.dispatch import receiver
+from django.utils import timezone
 
+from avatar.models import Avatar
+from document.models import AccessRight, Document
 from user.models import UserInvite
 from . import models
+from .helpers import (
+    bump_book_list_versions,
+    bump_book_styles_version,
+    clear_book_permissions_cache,
+    get_book_user_ids,
+    get_user_viewer_ids,
+    log_book_changes,
+    update_book_visibility,
+    update_user_book_visibility,
+)
 
 
 @receiver(pre_delete, sender=UserInvite)
@@ -10,26 +34,297 @@ def connect_book_invites(sender, instance, using, **kwargs):
     if not instance._apply or not instance.to:
         # Don't apply
         return
-    for right in models.BookAccessRight.objects.filter(
-        holder_type__model="userinvite", holder_id=instance.id
-    ):
-        old_ar = models.BookAccessRight.objects.filter(
-            holder_type__model="user",
-            holder_id=instance.to.id,
-            book=right.book,
-        ).first()
+    user = instance.to
+    invite_rights = list(
+        models.BookAccessRight.objects.filter(
+            holder_type__model="userinvite", holder_id=instance.id
+        ).annotate(book_owner_id=F("book__owner_id"))
+    )
+    if not invite_rights:
+        return
+    user_type = ContentType.objects.get_for_model(user)
+    user_rights = {
+        access_right.book_id: access_right
+        for access_right in models.BookAccessRight.objects.filter(
+            holder_type=user_type,
+            holder_id=user.id,
+            book_id__in=[right.book_id for right in invite_rights],
+        )
+    }
+    changed_rights = []
+    removed_rights = []
+    for right in invite_rights:
+        old_ar = user_rights.get(right.book_id)
         if old_ar:
             # If the user already has rights, we should only be upgrading
             # them, not downgrade.
-            if right.rights == "read":
-                pass
-            elif old_ar.rights == "write":
-                pass
-            else:
+            if right.rights != "read" and old_ar.rights != "write":
                 old_ar.rights = right.rights
-                old_ar.save()
-        elif right.book.owner == instance.to:
-            pass
+                changed_rights.append(old_ar)
+            removed_rights.append(right.id)
+        elif right.book_owner_id == user.id:
+            removed_rights.append(right.id)
         else:
-            right.holder_obj = instance.to
-            right.save()
+            right.holder_type = user_type
+            right.holder_id = user.id
+            changed_rights.append(right)
+    if removed_rights:
+        models.BookAccessRight.objects.filter(id__in=removed_rights).delete()
+    if changed_rights:
+        models.BookAccessRight.objects.bulk_update(
+            changed_rights, ["holder_type", "holder_id", "rights"]
+        )
+        # Bulk updates do not send signals.
+        log_book_changes(
+            {
+                access_right.book_id: {user.id}
+                for access_right in changed_rights
+            }
+        )
+        update_user_book_visibility(
+            {
+                access_right.book_id: {user.id}
+                for access_right in changed_rights
+            }
+        )
+
+
+@receiver(post_save, sender=models.Book)
+@receiver(pre_delete, sender=models.Book)
+def log_book_change(sender, instance, **kwargs):
+    # A deleted book is logged before its access rights are removed so that
+    # all its users are informed about the deletion.
+    origin = kwargs.get("origin")
+    if isinstance(origin, QuerySet) and origin.model is models.Book:
+        # Many books are deleted at once. Their users are looked up together
+        # and remembered for the other books of the deletion.
+        if not hasattr(origin, "book_user_ids"):
+            origin.book_user_ids = get_book_user_ids(
+                origin.values_list("id", flat=True)
+            )
+        log_book_changes({instance.id: origin.book_user_ids[instance.id]})
+        return
+    log_book_changes(get_book_user_ids([instance.id]))
+
+
+@receiver(post_save, sender=models.Chapter)
+def update_chapter_content_updated(sender, instance, **kwargs):
+    if kwargs.get("raw"):
+        # Loaded from a fixture.
+        return
+    text_updated = (
+        Document.objects.filter(id=instance.text_id)
+        .values_list("updated", flat=True)
+        .first()
+    )
+    models.Book.objects.filter(
+        id=instance.book_id, content_updated__lt=text_updated
+    ).update(content_updated=text_updated)
+
+
+def deleted_with_book(origin):
+    # Whether an object is deleted because the book it belongs to is deleted.
+    # The deletion of the book itself is logged, so nothing else needs to be
+    # done for the object.
+    return isinstance(origin, models.Book) or (
+        isinstance(origin, QuerySet) and origin.model is models.Book
+    )
+
+
+@receiver(post_delete, sender=models.Chapter)
+def update_removed_chapter_content_updated(sender, instance, **kwargs):
+    # Removing a chapter changes the contents of the book.
+    if deleted_with_book(kwargs.get("origin")):
+        return
+    models.Book.objects.filter(id=instance.book_id).update(
+        content_updated=timezone.now()
+    )
+
+
+@receiver(post_save, sender=models.Chapter)
+@receiver(post_delete, sender=models.Chapter)
+def log_chapter_change(sender, instance, **kwargs):
+    if deleted_with_book(kwargs.get("origin")):
+        return
+    log_book_changes(get_book_user_ids([instance.book_id]))
+
+
+@receiver(post_save, sender=Document)
+def log_chapter_document_change(sender, instance, **kwargs):
+    book_ids = list(
+        models.Chapter.objects.filter(text_id=instance.id).values_list(
+            "book_id", flat=True
+        )
+    )
+    if book_ids:
+        models.Book.objects.filter(
+            id__in=book_ids, content_updated__lt=instance.updated
+        ).update(content_updated=instance.updated)
+        log_book_changes(get_book_user_ids(book_ids))
+
+
+@receiver(pre_save, sender=models.BookAccessRight)
+def remember_access_right_holder(sender, instance, **kwargs):
+    # An access right can be moved to another holder or book. The previous
+    # ones are remembered, as they lose the access.
+    instance._previous_holder = None
+    if kwargs.get("raw") or instance._state.adding or instance.pk is None:
+        return
+    instance._previous_holder = (
+        models.BookAccessRight.objects.filter(id=instance.pk)
+        .values_list("book_id", "holder_type_id", "holder_id")
+        .first()
+    )
+
+
+def access_right_user_ids(instance):
+    # The ids of the users whose access to books is changed by an access
+    # right, mapped to the book ids. Only access rights of users make books
+    # visible.
+    user_ids = defaultdict(set)
+    holders = [(instance.book_id, instance.holder_type_id, instance.holder_id)]
+    previous_holder = getattr(instance, "_previous_holder", None)
+    if previous_holder:
+        holders.append(previous_holder)
+    for book_id, holder_type_id, holder_id in holders:
+        if ContentType.objects.get_for_id(holder_type_id).model == "user":
+            user_ids[book_id].add(holder_id)
+    return user_ids
+
+
+@receiver(post_save, sender=models.BookAccessRight)
+@receiver(post_delete, sender=models.BookAccessRight)
+def log_book_access_right_change(sender, instance, **kwargs):
+    if deleted_with_book(kwargs.get("origin")):
+        return
+    # Only the holders of the access right see a difference in the book list.
+    log_book_changes(access_right_user_ids(instance))
+
+
+@receiver(post_save, sender=models.Book)
+def update_book_owner_visibility(sender, instance, created, **kwargs):
+    dirty_fields = instance.dirty_fields()
+    if created or "owner_id" in dirty_fields:
+        # The previous owner may no longer see the book.
+        update_book_visibility([instance.id])
+    elif "path" in dirty_fields:
+        update_user_book_visibility({instance.id: {instance.owner_id}})
+
+
+@receiver(post_save, sender=models.BookAccessRight)
+@receiver(post_delete, sender=models.BookAccessRight)
+def update_access_right_visibility(sender, instance, **kwargs):
+    if deleted_with_book(kwargs.get("origin")):
+        return
+    update_user_book_visibility(access_right_user_ids(instance))
+
+
+@receiver(post_delete, sender=models.Book)
+def clear_deleted_book_permissions(sender, instance, **kwargs):
+    # The visibility of a deleted book is removed without signals.
+    clear_book_permissions_cache([instance.id])
+
+
+@receiver(post_save, sender=models.BookStyle)
+@receiver(post_delete, sender=models.BookStyle)
+@receiver(post_save, sender=models.BookStyleFile)
+@receiver(post_delete, sender=models.BookStyleFile)
+def bump_style_book_list_versions(sender, instance, **kwargs):
+    # Styles are part of the book list of every user.
+    if kwargs.get("raw"):
+        # Loaded from a fixture.
+        return
+    bump_book_list_versions()
+    # The cached styles are found by their version, so every process serves
+    # the new styles once the change has been committed.
+    bump_book_styles_version()
+
+
+@receiver(post_save, sender=Document)
+@receiver(pre_delete, sender=Document)
+def bump_document_book_list_versions(sender, instance, **kwargs):
+    # The documents of a user are part of the book list, as they can be
+    # added to books as chapters.
+    user_ids = set(
+        AccessRight.objects.filter(
+            document_id=instance.id, holder_type__model="user"
+        ).values_list("holder_id", flat=True)
+    )
+    user_ids.add(instance.owner_id)
+    bump_book_list_versions(user_ids)
+
+
+@receiver(post_save, sender=AccessRight)
+@receiver(post_delete, sender=AccessRight)
+def bump_document_access_right_book_list_versions(sender, instance, **kwargs):
+    holder_type = ContentType.objects.get_for_id(instance.holder_type_id)
+    if holder_type.model == "user":
+        bump_book_list_versions({instance.holder_id})
+
+
+@receiver(m2m_changed, sender=get_user_model().contacts.through)
+def bump_contact_book_list_versions(
+    sender, instance, action, pk_set, **kwargs
+):
+    # Contacts are part of the book list. Contacts are symmetrical, so the
+    # lists of both sides change.
+    if action == "pre_clear":
+        # The contacts that are about to be removed are unknown afterward.
+        bump_book_list_versions(
+            set(instance.contacts.values_list("id", flat=True))
+        )
+    if not action.startswith("post_"):
+        return
+    user_ids = {instance.id}
+    if pk_set:
+        user_ids.update(pk_set)
+    bump_book_list_versions(user_ids)
+
+
+@receiver(post_save, sender=UserInvite)
+@receiver(post_delete, sender=UserInvite)
+def bump_invite_book_list_versions(sender, instance, **kwargs):
+    # Invites are listed as contacts of the inviting user.
+    bump_book_list_versions({instance.by_id})
+
+
+# The fields of users that are shown in book lists.
+USER_NAME_FIELDS = ("username", "first_name", "last_name")
+
+
+@receiver(pre_save, sender=get_user_model())
+def remember_user_name(sender, instance, update_fields=None, **kwargs):
+    instance._previous_name = None
+    if kwargs.get("raw") or instance._state.adding or instance.pk is None:
+        return
+    if update_fields is not None and not set(update_fields).intersection(
+        USER_NAME_FIELDS
+    ):
+        # For example, only the time of the last login is saved.
+        return
+    instance._previous_name = (
+        get_user_model()
+        .objects.filter(id=instance.pk)
+        .values_list(*USER_NAME_FIELDS)
+        .first()
+    )
+
+
+@receiver(post_save, sender=get_user_model())
+def bump_user_name_book_list_versions(sender, instance, **kwargs):
+    # The names of users are shown in the book lists of other users.
+    previous_name = getattr(instance, "_previous_name", None)
+    if previous_name is None or previous_name == tuple(
+        getattr(instance, field) for field in USER_NAME_FIELDS
+    ):
+        return
+    bump_book_list_versions(get_user_viewer_ids(instance.id))
+
+
+@receiver(post_save, sender=Avatar)
+@receiver(post_delete, sender=Avatar)
+def bump_avatar_book_list_versions(sender, instance, **kwargs):
+    # The avatars of users are shown in the book lists of other users.
+    if kwargs.get("raw"):
+        return
+    bump_book_list_versions(get_user_viewer_ids(instance.user_id))
@@ -5,8 +5,8 @@ import {
     addAlert,
     escapeText,
     findTarget,
+    getJson,
     longFilePath,
-    post,
     postJson
 } from "../common"
 import {ImageSelectionDialog} from "../images/selection_dialog"
@@ -29,6 +29,10 @@ import {
     bookSanityCheckTemplate
 } from "./templates"
 
+// How often the progress of a deep copy of a book is checked, once a
+// second, before giving up.
+const COPY_JOB_MAX_ATTEMPTS = 600
+
 function emptyMetadata() {
     return {
         author: "",
@@ -40,6 +44,108 @@ function emptyMetadata() {
     }
 }
 
+function escapePointer(key) {
+    return key.replace(/~/g, "~0").replace(/\//g, "~1")
+}
+
+function isPlainObject(value) {
+    return typeof value === "object" && value !== null && !Array.isArray(value)
+}
+
+// JSON patch operations that turn oldValue into newValue. Plain objects are
+// compared key by key, other values are replaced as a whole.
+function jsonPatch(oldValue, newValue, path = "") {
+    if (!isPlainObject(oldValue) || !isPlainObject(newValue)) {
+        return JSON.stringify(oldValue) === JSON.stringify(newValue)
+            ? []
+            : [{op: "replace", path, value: newValue}]
+    }
+    const operations = []
+    Object.keys(oldValue).forEach(key => {
+        if (!(key in newValue)) {
+            operations.push({
+                op: "remove",
+                path: `${path}/${escapePointer(key)}`
+            })
+        }
+    })
+    Object.entries(newValue).forEach(([key, value]) => {
+        const keyPath = `${path}/${escapePointer(key)}`
+        if (!(key in oldValue)) {
+            operations.push({op: "add", path: keyPath, value})
+        } else {
+            operations.push(...jsonPatch(oldValue[key], value, keyPath))
+        }
+    })
+    return operations
+}
+
+// A copy of a book that can be changed without changing the book.
+function cloneBook(book) {
+    return Object.assign({}, book, {
+        metadata: Object.assign({}, book.metadata),
+        settings: Object.assign({}, book.settings),
+        chapters: book.chapters.map(chapter => Object.assign({}, chapter))
+    })
+}
+
+// Chapter operations that turn the oldChapters into the newChapters.
+function chapterOperations(oldChapters, newChapters) {
+    const operations = []
+    oldChapters.forEach(oldChapter => {
+        if (!newChapters.find(chapter => chapter.text === oldChapter.text)) {
+            operations.push({op: "remove", text: oldChapter.text})
+        }
+    })
+    newChapters.forEach(chapter => {
+        const oldChapter = oldChapters.find(
+            oldChapter => oldChapter.text === chapter.text
+        )
+        if (
+            !oldChapter ||
+            oldChapter.number !== chapter.number ||
+            oldChapter.part !== chapter.part
+        ) {
+            operations.push({
+                op: oldChapter ? "update" : "add",
+                text: chapter.text,
+                number: chapter.number,
+                part: chapter.part
+            })
+        }
+    })
+    return operations
+}
+
+// The changes of a book compared to the saved version of it.
+function bookPatch(oldBook, book) {
+    const patch = {version: oldBook.version}
+    for (const field of ["title", "path"]) {
+        if (oldBook[field] !== book[field]) {
+            patch[field] = book[field]
+        }
+    }
+    if ((oldBook.cover_image || false) !== (book.cover_image || false)) {
+        patch.cover_image = book.cover_image || null
+    }
+    for (const field of ["docx_template", "odt_template"]) {
+        if (oldBook[field] && !book[field]) {
+            patch[field] = null
+        }
+    }
+    for (const field of ["metadata", "settings"]) {
+        const operations = jsonPatch(oldBook[field], book[field])
+        if (operations.length) {
+            patch[field] = operations
+        }
+    }
+    const operations = chapterOperations(oldBook.chapters, book.chapters)
+    if (operations.length) {
+        patch.chapters = operations
+    }
+    return patch
+}
+
 export class BookActions {
     constructor(bookOverview) {
         bookOverview.mod.actions = this
@@ -90,33 +196,39 @@ export class BookActions {
         ]
     }
 
-    deleteBook(id) {
-        const book = this.bookOverview.bookList.find(book => book.id === id)
-        if (!book) {
-            return Promise.return()
+    deleteBooks(ids) {
+        const books = ids
+            .map(id => this.bookOverview.bookList.find(book => book.id === id))
+            .filter(book => book)
+        if (!books.length) {
+            return Promise.resolve()
         }
 
-        return post("/api/book/delete/", {id})
+        return postJson("/api/book/delete/", {ids: books.map(book => book.id)})
             .catch(error => {
-                addAlert(
-                    "error",
-                    `${gettext("Could not delete book")}: '${longFilePath(
-                        book.title,
-                        book.path
-                    )}'`
-                )
+                addAlert("error", gettext("Could not delete books"))
                 throw error
             })
-            .then(() => {
-                addAlert(
-                    "success",
-                    `${gettext("Book has been deleted")}: '${longFilePath(
-                        book.title,
-                        book.path
-                    )}'`
-                )
+            .then(({json}) => {
+                const deletedIds = []
+                json.results.forEach(({id, deleted}) => {
+                    const book = books.find(book => book.id === id)
+                    const bookPath = longFilePath(book.title, book.path)
+                    if (deleted) {
+                        deletedIds.push(id)
+                        addAlert(
+                            "success",
+                            `${gettext("Book has been deleted")}: '${bookPath}'`
+                        )
+                    } else {
+                        addAlert(
+                            "error",
+                            `${gettext("Could not delete book")}: '${bookPath}'`
+                        )
+                    }
+                })
                 this.bookOverview.bookList = this.bookOverview.bookList.filter(
-                    book => book.id !== id
+                    book => !deletedIds.includes(book.id)
                 )
                 this.bookOverview.initTable()
             })
@@ -135,10 +247,7 @@ export class BookActions {
                 text: gettext("Delete"),
                 classes: "fw-dark",
                 click: () => {
-                    Promise.all(ids.map(id => this.deleteBook(id))).then(() => {
-                        dialog.close()
-                        this.bookOverview.initTable()
-                    })
+                    this.deleteBooks(ids).then(() => dialog.close())
                 }
             }
         ]
@@ -234,11 +343,41 @@ export class BookActions {
             "book-settings-language"
         ).value
         book.path = oldBook?.path || this.bookOverview.path
-        const bookData = Object.assign({}, book)
-        delete bookData.cover_image_data
+        let request
+        if (oldBook) {
+            // Only send the changes of existing books.
+            request = postJson("/api/book/patch/", {
+                id: book.id,
+                patch: JSON.stringify(bookPatch(oldBook, book))
+            })
+        } else {
+            const bookData = Object.assign({}, book)
+            delete bookData.cover_image_data
+            request = postJson("/api/book/save/", {
+                book: JSON.stringify(bookData)
+            })
+        }
 
-        return postJson("/api/book/save/", {book: JSON.stringify(bookData)})
+        return request
             .catch(error => {
+                if (error.status === 409) {
+                    // Someone else has saved the book in the meantime.
+                    return error.json().then(json => {
+                        this.bookOverview.bookList =
+                            this.bookOverview.bookList.filter(
+                                book => book.id !== json.book.id
+                            )
+                        this.bookOverview.bookList.push(json.book)
+                        this.bookOverview.initTable()
+                        addAlert(
+                            "error",
+                            gettext(
+                                "The book has been changed by someone else. Please reopen it and apply your changes again."
+                            )
+                        )
+                        throw error
+                    })
+                }
                 addAlert("error", gettext("The book could not be saved"))
                 throw error
             })
@@ -247,6 +386,7 @@ export class BookActions {
                     book.id = json.id
                     book.added = json.added
                 }
+                book.version = json.version
                 book.updated = json.updated
                 if (oldBookId) {
                     this.bookOverview.bookList =
@@ -254,32 +394,102 @@ export class BookActions {
                             book => book.id !== oldBookId
                         )
                 }
-                this.bookOverview.bookList.push(book)
+                // The dialog may continue to change the book.
+                this.bookOverview.bookList.push(cloneBook(book))
                 this.bookOverview.initTable()
                 return Promise.all(this.onSave.map(method => method(book)))
             })
     }
 
     copyBook(oldBook) {
-        const book = Object.assign({}, oldBook)
-        book.is_owner = true
-        book.owner = this.bookOverview.user
-        book.rights = "write"
+        return this.copyBooks([oldBook])
+    }
+
+    copyBooks(oldBooks) {
+        const copies = oldBooks.map(oldBook => ({
+            id: oldBook.id,
+            path: longFilePath(
+                oldBook.title,
+                oldBook.path,
+                `${gettext("Copy of")} `
+            )
+        }))
+        return postJson("/api/book/copy/bulk/", {
+            books: JSON.stringify(copies)
+        })
+            .catch(error => {
+                addAlert("error", gettext("The books could not be copied"))
+                throw error
+            })
+            .then(({json}) => {
+                json.books.forEach(({id, path, original_id}) => {
+                    const book = Object.assign(
+                        {},
+                        oldBooks.find(oldBook => oldBook.id === original_id)
+                    )
+                    book.is_owner = true
+                    book.owner = this.bookOverview.user
+                    book.rights = "write"
+                    book.id = id
+                    book.path = path
+                    this.bookOverview.bookList.push(book)
+                })
+                json.results
+                    .filter(({copied}) => !copied)
+                    .forEach(({id}) => {
+                        const book = oldBooks.find(oldBook => oldBook.id === id)
+                        const bookPath = longFilePath(book.title, book.path)
+                        addAlert(
+                            "error",
+                            `${gettext("Could not copy book")}: '${bookPath}'`
+                        )
+                    })
+                this.bookOverview.initTable()
+            })
+    }
+
+    deepCopyBook(oldBook) {
         const path = longFilePath(
             oldBook.title,
             oldBook.path,
             `${gettext("Copy of")} `
         )
-        return postJson("/api/book/copy/", {id: book.id, path})
+        return postJson("/api/book/copy/deep/", {id: oldBook.id, path})
+            .then(({json}) => {
+                addAlert(
+                    "info",
+                    `${oldBook.title}: ${gettext("Copying has been initiated.")}`
+                )
+                return this.waitForCopyJob(json.job)
+            })
+            .then(json => {
+                // The copy has its own chapter documents.
+                this.bookOverview.bookList.push(json.book)
+                this.bookOverview.initTable()
+                addAlert(
+                    "success",
+                    `${oldBook.title}: ${gettext("The book has been copied.")}`
+                )
+            })
             .catch(error => {
                 addAlert("error", gettext("The book could not be copied"))
                 throw error
             })
-            .then(({json}) => {
-                book.id = json["id"]
-                book.path = json["path"]
-                this.bookOverview.bookList.push(book)
-                this.bookOverview.initTable()
+    }
+
+    waitForCopyJob(jobId, attempts = COPY_JOB_MAX_ATTEMPTS) {
+        if (attempts < 1) {
+            return Promise.reject(new Error("Copy job timed out"))
+        }
+        return new Promise(resolve => setTimeout(resolve, 1000))
+            .then(() => getJson(`/api/book/copy/job/${jobId}/`))
+            .then(json => {
+                if (json.status === "finished") {
+                    return json
+                } else if (json.status === "failed") {
+                    throw new Error("Copy job failed")
+                }
+                return this.waitForCopyJob(jobId, attempts - 1)
             })
     }
 
@@ -311,7 +521,9 @@ export class BookActions {
             const oldBook = this.bookOverview.bookList.find(
                 book => book.id === bookId
             )
-            book = Object.assign({}, oldBook)
+            // The dialog changes a copy of the book so that the changes can
+            // be found when saving.
+            book = cloneBook(oldBook)
             book.metadata = Object.assign(emptyMetadata(), oldBook.metadata)
             oldBookId = oldBook.id
 
@@ -15,7 +15,7 @@ import {
     ensureCSS,
     escapeText,
     findTarget,
-    postJson,
+    getJson,
     setDocTitle,
     shortFileTitle,
     whenReady
@@ -29,6 +29,9 @@ import {BookActions} from "./actions"
 import {bulkMenuModel, menuModel} from "./menu"
 import {dateCell, deleteFolderCell} from "./templates"
 
+// Number of books fetched per request of the book list.
+const BOOK_LIST_PAGE_SIZE = 100
+
 export class BookOverview {
     // A class that contains everything that happens on the books page.
     // It is currently not possible to initialize more than one such class,
@@ -428,7 +431,24 @@ export class BookOverview {
         if (this.app.isOffline()) {
             return cachedPromise
         }
-        return postJson("/api/book/list/")
+        return cachedPromise
+            .then(oldJson =>
+                (oldJson?.version !== undefined
+                    ? this.getBookListDelta(oldJson)
+                    : getJson("/api/book/list/", {
+                          page_size: BOOK_LIST_PAGE_SIZE
+                      }).then(json =>
+                          // Without cached data, we show each page as it
+                          // arrives.
+                          this.getBookListPages(json, !oldJson)
+                      )
+                ).then(json => {
+                    if (!deepEqual(json, oldJson)) {
+                        this.updateIndexedDB(json)
+                        this.initializeView(json)
+                    }
+                })
+            )
             .catch(error => {
                 if (this.app.isOffline()) {
                     return cachedPromise
@@ -437,17 +457,46 @@ export class BookOverview {
                     throw error
                 }
             })
-            .then(({json}) => {
-                return cachedPromise.then(oldJson => {
-                    if (!deepEqual(json, oldJson)) {
-                        this.updateIndexedDB(json)
-                        this.initializeView(json)
-                    }
-                })
-            })
             .then(() => deactivateWait())
     }
 
+    getBookListDelta(oldJson) {
+        // Fetch only the books that changed since the cached version and
+        // merge them into the cached list.
+        return getJson("/api/book/list/", {since: oldJson.version}).then(
+            json => {
+                const changedIds = new Set(
+                    json.books.map(book => book.id).concat(json.deleted)
+                )
+                json.books = oldJson.books
+                    .filter(book => !changedIds.has(book.id))
+                    .concat(json.books)
+                delete json.deleted
+                return json
+            }
+        )
+    }
+
+    getBookListPages(json, showPages) {
+        // Fetch the remaining pages of the book list one after the other.
+        if (showPages) {
+            this.initializeView(Object.assign({}, json))
+            deactivateWait()
+        }
+        if (!json.next_cursor) {
+            delete json.next_cursor
+            return Promise.resolve(json)
+        }
+        return getJson("/api/book/list/", {
+            page_size: BOOK_LIST_PAGE_SIZE,
+            cursor: json.next_cursor
+        }).then(page => {
+            json.books = json.books.concat(page.books)
+            json.next_cursor = page.next_cursor
+            return this.getBookListPages(json, showPages)
+        })
+    }
+
     initializeView(json) {
         this.bookList = json.books
         this.documentList = json.documents
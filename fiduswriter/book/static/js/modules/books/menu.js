@@ -269,10 +269,25 @@ export const bulkMenuModel = () => ({
         {
             title: gettext("Copy selected"),
             tooltip: gettext("Copy selected books."),
+            action: overview => {
+                const ids = overview.getSelected()
+                overview.mod.actions.copyBooks(
+                    ids.map(id =>
+                        overview.bookList.find(book => book.id === id)
+                    )
+                )
+            },
+            disabled: overview => !overview.getSelected().length
+        },
+        {
+            title: gettext("Copy selected with chapters"),
+            tooltip: gettext(
+                "Copy selected books including their chapter documents."
+            ),
             action: overview => {
                 const ids = overview.getSelected()
                 ids.forEach(id =>
-                    overview.mod.actions.copyBook(
+                    overview.mod.actions.deepCopyBook(
                         overview.bookList.find(book => book.id === id)
                     )
                 )
@@ -1,5 +1,10 @@
+import os
+
 from django.contrib.auth import get_user_model
-from book.models import Book
+from django.core.files.uploadedfile import SimpleUploadedFile
+from document.models import AccessRight, Document, DocumentTemplate
+from usermedia.models import Image
+from book.models import Book, BookAccessRight, Chapter
 
 
 def create_user(username, email, password):
@@ -13,3 +18,46 @@ def create_user(username, email, password):
 def create_book(user, title):
     book = Book.objects.create(title=title, owner=user)
     return book
+
+
+def share_book(book, user, rights="read", path=""):
+    access_right = BookAccessRight.objects.create(
+        book=book,
+        holder_obj=user,
+        rights=rights,
+        path=path,
+    )
+    return access_right
+
+
+def share_document(document, user, rights="read"):
+    access_right = AccessRight.objects.create(
+        document=document,
+        holder_obj=user,
+        rights=rights,
+    )
+    return access_right
+
+
+def create_chapter(book, title, number):
+    document = Document.objects.create(
+        title=title,
+        owner=book.owner,
+        template=DocumentTemplate.objects.first(),
+    )
+    chapter = Chapter.objects.create(book=book, text=document, number=number)
+    return chapter
+
+
+def create_image(user):
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    image_path = os.path.join(current_dir, "uploads", "image.png")
+    with open(image_path, "rb") as image_file:
+        image = Image(
+            uploader=user,
+            image=SimpleUploadedFile(
+                "image.png", image_file.read(), content_type="image/png"
+            ),
+        )
+        image.save()
+    return image
@@ -0,0 +1,255 @@
+import json
+from io import StringIO
+
+from django.core import mail
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from document.models import AccessRight
+from user.models import UserInvite
+from ..models import BookAccessRight
+from .helpers import create_user, create_book, create_chapter, share_book
+
+
+class BookAccessRightsTest(TestCase):
+    fixtures = ["initial_documenttemplates.json"]
+
+    def setUp(self):
+        self.client = Client()
+        self.user = create_user("testuser", "testuser@example.com", "password")
+        self.client.login(username="testuser@example.com", password="password")
+
+    def post(self, name, data):
+        return self.client.post(
+            reverse(name),
+            data,
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+        )
+
+    def test_get_access_rights_query_count(self):
+        books = [create_book(self.user, f"Book {i}") for i in range(3)]
+        collaborator = create_user(
+            "collaborator", "collaborator@example.com", "password"
+        )
+        invite = UserInvite.objects.create(
+            email="invited@example.com", username="invited", by=self.user
+        )
+        for book in books:
+            share_book(book, collaborator, "write")
+            share_book(book, invite)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post("get_access_rights", {})
+        self.assertEqual(response.status_code, 200)
+        access_rights = response.json()["access_rights"]
+        self.assertEqual(len(access_rights), 6)
+        self.assertEqual(
+            {
+                (ar["holder"]["type"], ar["holder"]["name"])
+                for ar in access_rights
+            },
+            {("user", "collaborator"), ("userinvite", "invited")},
+        )
+        query_count = len(queries)
+        for i in range(5):
+            collaborator = create_user(
+                f"collaborator{i}", f"collaborator{i}@example.com", "password"
+            )
+            for book in books:
+                share_book(book, collaborator)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post("get_access_rights", {})
+        self.assertEqual(len(response.json()["access_rights"]), 21)
+        self.assertEqual(len(queries), query_count)
+
+    def save_access_rights(self, books, rights):
+        return self.post(
+            "save_access_rights",
+            {
+                "book_ids": json.dumps([book.id for book in books]),
+                "access_rights": json.dumps(
+                    [
+                        {
+                            "holder": {
+                                "id": holder.id,
+                                "type": holder._meta.model_name,
+                            },
+                            "rights": holder_rights,
+                        }
+                        for holder, holder_rights in rights
+                    ]
+                ),
+            },
+        )
+
+    def test_save_access_rights(self):
+        book = create_book(self.user, "Book")
+        chapter = create_chapter(book, "Chapter", 1)
+        reader = create_user("reader", "reader@example.com", "password")
+        writer = create_user("writer", "writer@example.com", "password")
+        removed = create_user("removed", "removed@example.com", "password")
+        share_book(book, writer)
+        share_book(book, removed)
+        response = self.save_access_rights(
+            [book], [(reader, "read"), (writer, "write"), (removed, "delete")]
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            set(
+                BookAccessRight.objects.filter(book=book).values_list(
+                    "holder_id", "rights"
+                )
+            ),
+            {(reader.id, "read"), (writer.id, "write")},
+        )
+        self.assertEqual(
+            set(
+                AccessRight.objects.filter(
+                    document_id=chapter.text_id
+                ).values_list("holder_id", "rights")
+            ),
+            {(reader.id, "read"), (writer.id, "read")},
+        )
+        self.assertEqual(len(mail.outbox), 0)
+        call_command("send_book_emails", "--once", stdout=StringIO())
+        self.assertEqual(
+            sorted(message.to[0] for message in mail.outbox),
+            ["reader@example.com", "writer@example.com"],
+        )
+
+    def test_save_invalid_access_rights(self):
+        book = create_book(self.user, "Book")
+        collaborator = create_user(
+            "collaborator", "collaborator@example.com", "password"
+        )
+        for book_ids, rights in (
+            ([book.id], [{"holder": {"id": collaborator.id, "type": "x"}}]),
+            (
+                [book.id],
+                [
+                    {
+                        "holder": {"id": collaborator.id, "type": "group"},
+                        "rights": "read",
+                    }
+                ],
+            ),
+            (
+                [book.id],
+                [
+                    {
+                        "holder": {"id": collaborator.id, "type": "user"},
+                        "rights": "admin",
+                    }
+                ],
+            ),
+            ([book.id], [{"holder": collaborator.id, "rights": "read"}]),
+            ([book.id], {"rights": "read"}),
+            (book.id, []),
+            (["1"], []),
+        ):
+            response = self.post(
+                "save_access_rights",
+                {
+                    "book_ids": json.dumps(book_ids),
+                    "access_rights": json.dumps(rights),
+                },
+            )
+            self.assertEqual(response.status_code, 400, rights)
+        response = self.post(
+            "save_access_rights", {"book_ids": "[", "access_rights": "[]"}
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(BookAccessRight.objects.filter(book=book).exists())
+
+    def test_save_access_rights_query_count(self):
+        def share(count):
+            books = [create_book(self.user, f"Book {i}") for i in range(count)]
+            for book in books:
+                create_chapter(book, "Chapter", 1)
+            collaborators = [
+                create_user(
+                    f"collaborator{count}-{i}",
+                    f"collaborator{count}-{i}@example.com",
+                    "password",
+                )
+                for i in range(count)
+            ]
+            removed = create_user(
+                f"removed{count}", f"removed{count}@example.com", "password"
+            )
+            for book in books:
+                share_book(book, collaborators[0])
+                share_book(book, removed)
+            invite = UserInvite.objects.create(
+                email=f"invited{count}@example.com",
+                username=f"invited{count}",
+                by=self.user,
+            )
+            rights = [
+                (collaborator, "write") for collaborator in collaborators
+            ]
+            rights += [(invite, "read"), (removed, "delete")]
+            with CaptureQueriesContext(connection) as queries:
+                response = self.save_access_rights(books, rights)
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(
+                BookAccessRight.objects.filter(book__in=books).count(),
+                count * (count + 1),
+            )
+            return len(queries)
+
+        self.assertEqual(share(2), share(6))
+
+    def accept_invite(self, books, invited_user):
+        invite = UserInvite.objects.create(
+            email=invited_user.email,
+            username=invited_user.username,
+            by=self.user,
+            to=invited_user,
+        )
+        for book in books:
+            share_book(book, invite, "write")
+        invite._apply = True
+        with CaptureQueriesContext(connection) as queries:
+            invite.delete()
+        return len(queries)
+
+    def test_connect_book_invites(self):
+        invited_user = create_user(
+            "invited", "invited@example.com", "password"
+        )
+        upgraded = create_book(self.user, "Upgraded")
+        share_book(upgraded, invited_user, "read")
+        owned = create_book(invited_user, "Owned")
+        transferred = create_book(self.user, "Transferred")
+        self.accept_invite([upgraded, owned, transferred], invited_user)
+        self.assertFalse(
+            BookAccessRight.objects.filter(
+                holder_type__model="userinvite"
+            ).exists()
+        )
+        self.assertEqual(
+            set(
+                BookAccessRight.objects.values_list(
+                    "book_id", "holder_id", "rights"
+                )
+            ),
+            {
+                (upgraded.id, invited_user.id, "write"),
+                (transferred.id, invited_user.id, "write"),
+            },
+        )
+
+    def test_connect_book_invites_query_count(self):
+        def accept(count):
+            invited_user = create_user(
+                f"invited{count}", f"invited{count}@example.com", "password"
+            )
+            books = [create_book(self.user, f"Book {i}") for i in range(count)]
+            for book in books[: count // 2]:
+                share_book(book, invited_user, "read")
+            return self.accept_invite(books, invited_user)
+
+        self.assertEqual(accept(2), accept(8))
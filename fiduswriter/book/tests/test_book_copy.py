@@ -0,0 +1,266 @@
+import json
+from io import StringIO
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from book.models import Book, BookCopyJob, Chapter
+from document.models import Document
+from usermedia.models import DocumentImage
+from .helpers import (
+    create_user,
+    create_book,
+    create_chapter,
+    create_image,
+    share_book,
+    share_document,
+)
+
+
+class BookCopyTest(TestCase):
+    fixtures = [
+        "initial_documenttemplates.json",
+    ]
+
+    def setUp(self):
+        self.client = Client()
+        self.user = create_user("testuser", "testuser@example.com", "password")
+        self.client.login(username="testuser@example.com", password="password")
+        self.book = create_book(self.user, "Book")
+        for i in range(1, 4):
+            create_chapter(self.book, f"Chapter {i}", i)
+
+    def post(self, name, data):
+        return self.client.post(
+            reverse(name),
+            data,
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+        )
+
+    def copy(self, path):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post(
+                "book_copy", {"id": self.book.id, "path": path}
+            )
+        self.assertEqual(response.status_code, 201)
+        return response.json(), len(queries)
+
+    def test_copy(self):
+        json_response, _query_count = self.copy("Folder/Copy of Book")
+        self.assertEqual(json_response["path"], "Folder/Copy of Book")
+        book = Book.objects.get(id=json_response["id"])
+        self.assertEqual(book.owner, self.user)
+        self.assertEqual(book.title, "Book")
+        self.assertEqual(
+            list(
+                Chapter.objects.filter(book=book)
+                .order_by("number")
+                .values_list("text__title", flat=True)
+            ),
+            ["Chapter 1", "Chapter 2", "Chapter 3"],
+        )
+
+    def test_copy_free_path_query_count(self):
+        json_response, query_count = self.copy("Copy of Book")
+        self.assertEqual(json_response["path"], "Copy of Book")
+        other_user = create_user("other", "other@example.com", "password")
+        for i in range(1, 21):
+            Book.objects.create(
+                title="Book", owner=self.user, path=f"Copy of Book {i}"
+            )
+            share_book(
+                create_book(other_user, "Book"),
+                self.user,
+                path=f"Copy of Book {i + 20}",
+            )
+        json_response, path_query_count = self.copy("Copy of Book")
+        self.assertEqual(json_response["path"], "Copy of Book 41")
+        self.assertEqual(path_query_count, query_count)
+
+    def test_copy_no_access(self):
+        other_user = create_user("other", "other@example.com", "password")
+        book = create_book(other_user, "Other book")
+        response = self.post("book_copy", {"id": book.id, "path": ""})
+        self.assertEqual(response.status_code, 405)
+
+    def test_copy_bulk(self):
+        other_user = create_user("other", "other@example.com", "password")
+        shared_book = create_book(other_user, "Shared book")
+        create_chapter(shared_book, "Shared chapter", 1)
+        share_book(shared_book, self.user)
+        private_book = create_book(other_user, "Private book")
+        response = self.post(
+            "book_copy_bulk",
+            {
+                "books": json.dumps(
+                    [
+                        {"id": self.book.id, "path": "Copy"},
+                        {"id": shared_book.id, "path": "Copy"},
+                        {"id": private_book.id, "path": "Copy"},
+                    ]
+                )
+            },
+        )
+        self.assertEqual(response.status_code, 201)
+        books = response.json()["books"]
+        self.assertEqual(
+            [(book["original_id"], book["path"]) for book in books],
+            [(self.book.id, "Copy"), (shared_book.id, "Copy 1")],
+        )
+        self.assertEqual(
+            Chapter.objects.filter(book_id=books[0]["id"]).count(), 3
+        )
+        self.assertEqual(
+            Chapter.objects.filter(book_id=books[1]["id"]).count(), 1
+        )
+        self.assertEqual(Book.objects.get(id=books[1]["id"]).owner, self.user)
+
+        self.assertEqual(
+            response.json()["results"],
+            [
+                {"id": self.book.id, "copied": True},
+                {"id": shared_book.id, "copied": True},
+                {"id": private_book.id, "copied": False},
+            ],
+        )
+
+    def test_copy_bulk_invalid(self):
+        book_count = Book.objects.count()
+        for data in (
+            {},
+            {"books": "["},
+            {"books": json.dumps({"id": self.book.id, "path": "Copy"})},
+            {"books": json.dumps([{"id": self.book.id}])},
+            {"books": json.dumps([{"id": str(self.book.id), "path": ""}])},
+            {"books": json.dumps([self.book.id])},
+        ):
+            response = self.post("book_copy_bulk", data)
+            self.assertEqual(response.status_code, 400, data)
+        self.assertEqual(Book.objects.count(), book_count)
+
+    def test_copy_deep(self):
+        other_user = create_user("other", "other@example.com", "password")
+        book = create_book(other_user, "Shared book")
+        share_book(book, self.user)
+        chapter = create_chapter(book, "Chapter", 1)
+        chapter.text.comments = {"1": {"comment": "A comment"}}
+        chapter.text.save()
+        share_document(chapter.text, self.user)
+        image = create_image(other_user)
+        DocumentImage.objects.create(document=chapter.text, image=image)
+        response = self.post(
+            "book_copy_deep", {"id": book.id, "path": "Copy of Shared book"}
+        )
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json()["job"]
+        response = self.client.get(
+            reverse("book_copy_job", args=[job_id]),
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+        )
+        self.assertEqual(response.json()["status"], "pending")
+        call_command("run_book_copy_jobs", "--once", stdout=StringIO())
+        response = self.client.get(
+            reverse("book_copy_job", args=[job_id]),
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+        )
+        progress = response.json()
+        self.assertEqual(progress["status"], "finished")
+        self.assertEqual(progress["chapters_total"], 1)
+        self.assertEqual(progress["chapters_copied"], 1)
+        self.assertEqual(progress["path"], "Copy of Shared book")
+        new_chapter = Chapter.objects.get(book_id=progress["id"])
+        self.assertEqual(progress["book"]["id"], progress["id"])
+        self.assertEqual(
+            [chapter["text"] for chapter in progress["book"]["chapters"]],
+            [new_chapter.text_id],
+        )
+        new_text = new_chapter.text
+        self.assertNotEqual(new_text.id, chapter.text_id)
+        self.assertEqual(new_text.owner, self.user)
+        self.assertEqual(new_text.title, "Chapter")
+        self.assertEqual(new_text.comments, {"1": {"comment": "A comment"}})
+        self.assertTrue(new_text.listed)
+        self.assertEqual(
+            DocumentImage.objects.get(document=new_text).image, image
+        )
+
+    def test_copy_deep_unreadable_chapters(self):
+        owner = create_user("owner", "owner@example.com", "password")
+        collaborator = create_user(
+            "collaborator", "collaborator@example.com", "password"
+        )
+        book = create_book(owner, "Shared book")
+        share_book(book, self.user)
+        owned_chapter = create_chapter(book, "Owned", 1)
+        shared_chapter = create_chapter(book, "Shared", 2)
+        share_document(shared_chapter.text, self.user)
+        # A chapter of a third user that has not been shared with the user.
+        private_chapter = create_chapter(book, "Private", 3)
+        private_chapter.text.owner = collaborator
+        private_chapter.text.save()
+        owned_chapter.text.owner = self.user
+        owned_chapter.text.save()
+        response = self.post("book_copy_deep", {"id": book.id, "path": ""})
+        self.assertEqual(response.status_code, 202)
+        call_command("run_book_copy_jobs", "--once", stdout=StringIO())
+        job = BookCopyJob.objects.get(id=response.json()["job"])
+        self.assertEqual(job.status, "finished")
+        self.assertEqual(job.chapters_total, 2)
+        self.assertEqual(
+            sorted(
+                Chapter.objects.filter(book=job.new_book).values_list(
+                    "text__title", flat=True
+                )
+            ),
+            ["Owned", "Shared"],
+        )
+        self.assertFalse(
+            Document.objects.filter(owner=self.user, title="Private").exists()
+        )
+
+    def test_copy_deep_access_lost(self):
+        other_user = create_user("other", "other@example.com", "password")
+        book = create_book(other_user, "Shared book")
+        access_right = share_book(book, self.user)
+        create_chapter(book, "Chapter", 1)
+        response = self.post("book_copy_deep", {"id": book.id, "path": ""})
+        self.assertEqual(response.status_code, 202)
+        access_right.delete()
+        call_command("run_book_copy_jobs", "--once", stdout=StringIO())
+        job = BookCopyJob.objects.get(id=response.json()["job"])
+        self.assertEqual(job.status, "failed")
+        self.assertIsNone(job.new_book)
+        self.assertFalse(
+            Book.objects.filter(owner=self.user)
+            .exclude(id=self.book.id)
+            .exists()
+        )
+
+    def test_copy_deep_failed(self):
+        book = create_book(self.user, "Book")
+        for number in range(1, 4):
+            create_chapter(book, f"Chapter {number}", number)
+        document_count = Document.objects.count()
+        response = self.post("book_copy_deep", {"id": book.id, "path": ""})
+        with (
+            patch("book.jobs.COPY_BATCH_SIZE", 1),
+            patch("book.jobs.free_paths", side_effect=Exception),
+            self.assertLogs("book.jobs", level="ERROR"),
+        ):
+            call_command("run_book_copy_jobs", "--once", stdout=StringIO())
+        job = BookCopyJob.objects.get(id=response.json()["job"])
+        self.assertEqual(job.status, "failed")
+        self.assertEqual(job.chapters_copied, 3)
+        # The documents that were copied before the failure are removed.
+        self.assertEqual(Document.objects.count(), document_count)
+
+    def test_copy_deep_no_access(self):
+        other_user = create_user("other", "other@example.com", "password")
+        book = create_book(other_user, "Other book")
+        response = self.post("book_copy_deep", {"id": book.id, "path": ""})
+        self.assertEqual(response.status_code, 405)
+        self.assertFalse(BookCopyJob.objects.exists())
@@ -0,0 +1,103 @@
+from django.db import connection
+from django.test import TestCase, Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from book.models import Book, BookChange, Chapter
+from usermedia.models import Image
+from .helpers import (
+    create_user,
+    create_book,
+    create_chapter,
+    create_image,
+    share_book,
+)
+
+
+class BookDeleteTest(TestCase):
+    fixtures = [
+        "initial_documenttemplates.json",
+    ]
+
+    def setUp(self):
+        self.client = Client()
+        self.user = create_user("testuser", "testuser@example.com", "password")
+        self.client.login(username="testuser@example.com", password="password")
+        self.other_user = create_user("other", "other@example.com", "password")
+
+    def delete(self, book_ids):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                reverse("book_delete"),
+                {"ids[]": book_ids},
+                HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+            )
+        return response, len(queries)
+
+    def create_books(self, count):
+        books = []
+        for i in range(count):
+            book = create_book(self.user, f"Book {i}")
+            create_chapter(book, "Chapter 1", 1)
+            create_chapter(book, "Chapter 2", 2)
+            share_book(book, self.other_user)
+            books.append(book)
+        return books
+
+    def test_delete(self):
+        books = self.create_books(2)
+        other_book = create_book(self.other_user, "Other book")
+        response, _query_count = self.delete(
+            [books[0].id, books[1].id, other_book.id]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json()["results"],
+            [
+                {"id": books[0].id, "deleted": True},
+                {"id": books[1].id, "deleted": True},
+                {"id": other_book.id, "deleted": False},
+            ],
+        )
+        self.assertEqual(list(Book.objects.all()), [other_book])
+        self.assertFalse(Chapter.objects.exists())
+        # The users of the books are informed about the deletion.
+        self.assertEqual(
+            set(BookChange.objects.values_list("book_id", "user_id")),
+            {
+                (book.id, user.id)
+                for book in books
+                for user in [self.user, self.other_user]
+            }
+            | {(other_book.id, self.other_user.id)},
+        )
+
+    def test_delete_not_permitted(self):
+        other_book = create_book(self.other_user, "Other book")
+        response, _query_count = self.delete([other_book.id])
+        self.assertEqual(response.status_code, 405)
+        self.assertTrue(Book.objects.filter(id=other_book.id).exists())
+
+    def test_delete_cover_images(self):
+        unused_image = create_image(self.user)
+        used_image = create_image(self.user)
+        books = self.create_books(3)
+        other_book = create_book(self.user, "Other book")
+        Book.objects.filter(id=books[0].id).update(cover_image=unused_image)
+        Book.objects.filter(id__in=[books[1].id, other_book.id]).update(
+            cover_image=used_image
+        )
+        response, _query_count = self.delete([book.id for book in books])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            list(Image.objects.values_list("id", flat=True)), [used_image.id]
+        )
+
+    def test_delete_query_count(self):
+        _response, query_count = self.delete(
+            [book.id for book in self.create_books(2)]
+        )
+        _response, more_query_count = self.delete(
+            [book.id for book in self.create_books(8)]
+        )
+        self.assertEqual(more_query_count, query_count)
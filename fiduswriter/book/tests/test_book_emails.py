@@ -0,0 +1,136 @@
+from io import StringIO
+from unittest import mock
+
+from django.core import mail
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from .. import emails
+from ..emails import (
+    queue_mails,
+    send_queued_mails,
+    share_notification_emails,
+)
+from ..models import OutgoingEmail
+from .helpers import create_book, create_user
+
+
+class BookEmailsTest(TestCase):
+    def queue(self, count):
+        queue_mails(
+            [
+                OutgoingEmail(
+                    subject=f"Subject {i}",
+                    message="Message",
+                    html_message="<p>Message</p>",
+                    from_email="from@example.com",
+                    to=f"to{i}@example.com",
+                )
+                for i in range(count)
+            ]
+        )
+
+    def test_send_queued_mails(self):
+        self.queue(3)
+        self.assertEqual(len(mail.outbox), 0)
+        output = StringIO()
+        call_command("send_book_emails", "--once", stdout=output)
+        self.assertIn("Sent 3 emails, 0 failed", output.getvalue())
+        self.assertEqual(
+            [message.to for message in mail.outbox],
+            [["to0@example.com"], ["to1@example.com"], ["to2@example.com"]],
+        )
+        self.assertEqual(mail.outbox[0].alternatives[0][0], "<p>Message</p>")
+        self.assertFalse(OutgoingEmail.objects.filter(sent=None).exists())
+        call_command("send_book_emails", "--once", stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_batches_use_one_connection(self):
+        self.queue(5)
+        with mock.patch(
+            "book.emails.get_connection", wraps=mail.get_connection
+        ) as get_connection:
+            self.assertEqual(send_queued_mails(batch_size=2), (2, 0))
+        self.assertEqual(get_connection.call_count, 1)
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_retry_failed_mails(self):
+        self.queue(1)
+        with mock.patch(
+            "django.core.mail.EmailMessage.send",
+            side_effect=OSError("Mail server unavailable"),
+        ):
+            self.assertEqual(send_queued_mails(), (0, 1))
+        email = OutgoingEmail.objects.get()
+        self.assertEqual(email.attempts, 1)
+        self.assertEqual(email.last_error, "Mail server unavailable")
+        self.assertGreater(email.next_attempt, timezone.now())
+        # The email is not retried before the next attempt is due.
+        self.assertEqual(send_queued_mails(), (0, 0))
+        OutgoingEmail.objects.update(next_attempt=timezone.now())
+        self.assertEqual(send_queued_mails(), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+        email.refresh_from_db()
+        self.assertEqual(email.attempts, 2)
+
+    def test_give_up_after_max_attempts(self):
+        self.queue(1)
+        OutgoingEmail.objects.update(attempts=4)
+        with (
+            mock.patch(
+                "django.core.mail.EmailMessage.send",
+                side_effect=OSError("Mail server unavailable"),
+            ),
+            self.assertLogs("book.emails", level="ERROR") as logs,
+        ):
+            self.assertEqual(send_queued_mails(max_attempts=5), (0, 1))
+        self.assertIn("after 5 attempts", logs.output[0])
+        OutgoingEmail.objects.update(next_attempt=timezone.now())
+        self.assertEqual(send_queued_mails(max_attempts=5), (0, 0))
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_send_outside_of_transaction(self):
+        self.queue(2)
+
+        def send(message):
+            # Other workers do not get the emails that are being sent.
+            self.assertEqual(send_queued_mails(), (0, 0))
+            return 1
+
+        with mock.patch("django.core.mail.EmailMessage.send", send):
+            self.assertEqual(send_queued_mails(), (2, 0))
+        self.assertFalse(OutgoingEmail.objects.filter(sent=None).exists())
+
+    def test_share_notification_digest(self):
+        owner = create_user("owner", "owner@example.com", "password")
+        books = [create_book(owner, f"Book {i}") for i in range(3)]
+        collaborators = [
+            create_user(f"user{i}", f"user{i}@example.com", "password")
+            for i in range(3)
+        ]
+        notifications = [
+            (book, collaborator, "write", False)
+            for book in books
+            for collaborator in collaborators[:2]
+        ]
+        notifications.append((books[0], collaborators[2], "read", True))
+        with mock.patch(
+            "book.emails.render_book_list",
+            wraps=emails.render_book_list,
+        ) as render_book_list:
+            outgoing_emails = share_notification_emails(
+                "Owner", "http://localhost/books/", notifications
+            )
+        self.assertEqual(render_book_list.call_count, 1)
+        self.assertEqual(
+            [email.to for email in outgoing_emails],
+            ["user0@example.com", "user1@example.com", "user2@example.com"],
+        )
+        digest = outgoing_emails[0]
+        self.assertEqual(digest.subject, "Books shared by Owner")
+        self.assertIn("Hey user0,", digest.message)
+        for book in books:
+            self.assertIn(f"'{book.title}': write", digest.message)
+            self.assertIn(f"<b>{book.title}</b>", digest.html_message)
+        self.assertEqual(outgoing_emails[2].subject, "Book shared: Book 0")
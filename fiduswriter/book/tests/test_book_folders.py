@@ -0,0 +1,113 @@
+import time
+from datetime import timedelta
+
+from django.test import TestCase, Client
+from django.urls import reverse
+from django.utils import timezone
+
+from book.models import Book
+from .helpers import create_user, create_book, share_book
+
+
+class BookFoldersTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = create_user("testuser", "testuser@example.com", "password")
+        self.client.login(username="testuser@example.com", password="password")
+        self.other_user = create_user("other", "other@example.com", "password")
+
+    def get(self, name, data):
+        return self.client.get(
+            reverse(name), data, HTTP_X_REQUESTED_WITH="XMLHttpRequest"
+        )
+
+    def create_book(self, title, path, updated=None):
+        return Book.objects.create(
+            title=title,
+            owner=self.user,
+            path=path,
+            content_updated=updated or timezone.now(),
+        )
+
+    def test_folders(self):
+        latest = timezone.now()
+        self.create_book("A", "/Folder/A", latest - timedelta(days=2))
+        self.create_book("B", "/Folder/Sub/B", latest - timedelta(days=3))
+        self.create_book("C", "Other/", latest - timedelta(days=1))
+        self.create_book("D", "/D", latest)
+        self.create_book("E", "", latest)
+        shared = create_book(self.other_user, "Shared")
+        Book.objects.filter(id=shared.id).update(content_updated=latest)
+        share_book(shared, self.user, path="/Folder/Shared")
+        share_book(
+            create_book(self.other_user, "Not shared with user"),
+            create_user("third", "third@example.com", "password"),
+            path="/Folder/Not shared",
+        )
+        response = self.get("book_folders", {})
+        self.assertEqual(response.status_code, 200)
+        folders = response.json()["folders"]
+        self.assertEqual(
+            [(folder["name"], folder["count"]) for folder in folders],
+            [("Folder", 3), ("Other", 1)],
+        )
+        self.assertEqual(folders[0]["path"], "/Folder/")
+        self.assertEqual(
+            folders[0]["updated"], time.mktime(latest.utctimetuple())
+        )
+        response = self.get("book_folders", {"path": "/Folder/"})
+        self.assertEqual(
+            [
+                (folder["name"], folder["count"])
+                for folder in response.json()["folders"]
+            ],
+            [("Sub", 1)],
+        )
+
+    def test_list_folder(self):
+        self.create_book("A", "/Folder/A")
+        self.create_book("B", "/Folder/Sub/B")
+        self.create_book("C", "/Folder/")
+        self.create_book("D", "/D")
+        shared = create_book(self.other_user, "Shared")
+        share_book(shared, self.user, path="/Folder/Shared")
+        response = self.get(
+            "book_list", {"folder": "/Folder/", "page_size": 2}
+        )
+        self.assertEqual(response.status_code, 200)
+        json_response = response.json()
+        titles = [book["title"] for book in json_response["books"]]
+        response = self.get(
+            "book_list",
+            {
+                "folder": "/Folder/",
+                "page_size": 2,
+                "cursor": json_response["next_cursor"],
+            },
+        )
+        titles += [book["title"] for book in response.json()["books"]]
+        self.assertEqual(sorted(titles), ["A", "C", "Shared"])
+
+    def test_invalid_folder(self):
+        response = self.get("book_folders", {"path": "Folder"})
+        self.assertEqual(response.status_code, 400)
+        response = self.get("book_list", {"folder": "/Folder/", "since": 1})
+        self.assertEqual(response.status_code, 400)
+
+    def test_folder_case(self):
+        self.create_book("Upper", "/A/Upper")
+        self.create_book("Lower", "/a/Lower")
+        self.create_book("Upper sub", "/A/Sub/Book")
+        self.create_book("Lower sub", "/a/Sub/Book")
+        response = self.get("book_list", {"folder": "/A/"})
+        self.assertEqual(
+            [book["title"] for book in response.json()["books"]], ["Upper"]
+        )
+        response = self.get("book_folders", {"path": "/A/"})
+        self.assertEqual(
+            [
+                (folder["name"], folder["count"])
+                for folder in response.json()["folders"]
+            ],
+            [("Sub", 1)],
+        )
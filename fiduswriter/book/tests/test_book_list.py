@@ -0,0 +1,332 @@
+from django.core.cache import cache
+from django.db import connection
+from unittest import skipUnless
+
+from django.db.models import F
+from django.test import TestCase, Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from avatar.models import Avatar
+from book.helpers import log_book_changes
+from book.models import Book, BookChange, BookStyle, BookStylesVersion
+from book.views import visible_books
+from user.models import User
+from .helpers import (
+    create_user,
+    create_book,
+    create_chapter,
+    create_image,
+    share_book,
+)
+
+
+class BookListTest(TestCase):
+    fixtures = [
+        "initial_documenttemplates.json",
+    ]
+
+    def setUp(self):
+        self.client = Client()
+        self.user = create_user("testuser", "testuser@example.com", "password")
+        self.owner = create_user("owner", "owner@example.com", "password")
+        self.client.login(username="testuser@example.com", password="password")
+
+    def get_list(self, data=None):
+        return self.client.post(
+            reverse("book_list"),
+            data or {},
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+        )
+
+    def count_list_queries(self, data=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get_list(data)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.json()
+
+    def test_shared_books_rights_and_paths(self):
+        create_book(self.user, "Own Book")
+        shared_book = create_book(self.owner, "Shared Book")
+        share_book(shared_book, self.user, "write", "/shared/Shared Book")
+        response = self.get_list()
+        books = {book["title"]: book for book in response.json()["books"]}
+        self.assertEqual(books["Own Book"]["rights"], "write")
+        self.assertTrue(books["Own Book"]["is_owner"])
+        self.assertEqual(books["Shared Book"]["rights"], "write")
+        self.assertEqual(books["Shared Book"]["path"], "/shared/Shared Book")
+        self.assertFalse(books["Shared Book"]["is_owner"])
+
+    def test_shared_books_query_count(self):
+        for i in range(2):
+            share_book(create_book(self.owner, f"Book {i}"), self.user)
+        query_count, json = self.count_list_queries()
+        self.assertEqual(len(json["books"]), 2)
+        for i in range(2, 12):
+            share_book(create_book(self.owner, f"Book {i}"), self.user)
+        more_query_count, json = self.count_list_queries()
+        self.assertEqual(len(json["books"]), 12)
+        self.assertEqual(query_count, more_query_count)
+
+    def test_paginated_list(self):
+        for i in range(5):
+            create_book(self.user, f"Own Book {i}")
+        for i in range(4):
+            share_book(create_book(self.owner, f"Shared Book {i}"), self.user)
+        full_list = self.get_list().json()
+        self.assertNotIn("next_cursor", full_list)
+        page = self.get_list({"page_size": 4}).json()
+        self.assertIn("documents", page)
+        self.assertIn("contacts", page)
+        self.assertIn("styles", page)
+        book_ids = [book["id"] for book in page["books"]]
+        self.assertEqual(len(book_ids), 4)
+        while page["next_cursor"]:
+            page = self.get_list(
+                {"page_size": 4, "cursor": page["next_cursor"]}
+            ).json()
+            self.assertNotIn("documents", page)
+            self.assertLessEqual(len(page["books"]), 4)
+            book_ids += [book["id"] for book in page["books"]]
+        self.assertEqual(book_ids, [book["id"] for book in full_list["books"]])
+
+    def test_paginated_list_invalid_cursor(self):
+        response = self.get_list({"page_size": 4, "cursor": "invalid"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_delta_list(self):
+        own_book = create_book(self.user, "Own Book")
+        unchanged_book = create_book(self.user, "Unchanged Book")
+        shared_book = create_book(self.owner, "Shared Book")
+        access_right = share_book(shared_book, self.user)
+        version = self.get_list().json()["version"]
+        delta = self.get_list({"since": version}).json()
+        self.assertEqual(delta["books"], [])
+        self.assertEqual(delta["deleted"], [])
+        self.assertEqual(delta["version"], version)
+
+        own_book = Book.objects.get(id=own_book.id)
+        own_book.title = "Changed Book"
+        own_book.save()
+        access_right.delete()
+        delta = self.get_list({"since": version}).json()
+        self.assertEqual(
+            [book["title"] for book in delta["books"]], ["Changed Book"]
+        )
+        self.assertEqual(delta["deleted"], [shared_book.id])
+        self.assertGreater(delta["version"], version)
+
+        version = delta["version"]
+        unchanged_book_id = unchanged_book.id
+        unchanged_book.delete()
+        delta = self.get_list({"since": version}).json()
+        self.assertEqual(delta["books"], [])
+        self.assertEqual(delta["deleted"], [unchanged_book_id])
+
+    def test_delta_list_change_order(self):
+        book = create_book(self.user, "Book")
+        version = self.get_list().json()["version"]
+        log_book_changes({book.id: {self.user.id}})
+        # The id of a change can be lower than the ids of changes that were
+        # committed before it. Only the version of the change counts.
+        BookChange.objects.filter(book_id=book.id).update(id=0)
+        delta = self.get_list({"since": version}).json()
+        self.assertEqual([book["title"] for book in delta["books"]], ["Book"])
+        self.assertEqual(
+            BookChange.objects.get(book_id=book.id).version, delta["version"]
+        )
+
+    def test_list_etag(self):
+        book = create_book(self.user, "Own Book")
+        response = self.client.get(
+            reverse("book_list"), HTTP_X_REQUESTED_WITH="XMLHttpRequest"
+        )
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                reverse("book_list"),
+                HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+                HTTP_IF_NONE_MATCH=etag,
+            )
+        self.assertEqual(response.status_code, 304)
+        for query in queries:
+            self.assertNotIn('"book_book"', query["sql"])
+            self.assertNotIn('"document_document"', query["sql"])
+        book = Book.objects.get(id=book.id)
+        book.title = "Changed Book"
+        book.save()
+        response = self.client.get(
+            reverse("book_list"),
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+            HTTP_IF_NONE_MATCH=etag,
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_list_etag_post(self):
+        etag = self.client.get(
+            reverse("book_list"), HTTP_X_REQUESTED_WITH="XMLHttpRequest"
+        )["ETag"]
+        # Only GET requests are conditional.
+        response = self.client.post(
+            reverse("book_list"),
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+            HTTP_IF_NONE_MATCH=etag,
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("ETag", response)
+
+    def test_list_etag_user_changes(self):
+        share_book(create_book(self.owner, "Shared Book"), self.user)
+        etag = self.client.get(
+            reverse("book_list"), HTTP_X_REQUESTED_WITH="XMLHttpRequest"
+        )["ETag"]
+
+        def get_list_status():
+            return self.client.get(
+                reverse("book_list"),
+                HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+                HTTP_IF_NONE_MATCH=etag,
+            ).status_code
+
+        owner = User.objects.get(id=self.owner.id)
+        owner.last_login = timezone.now()
+        owner.save(update_fields=["last_login"])
+        owner.save()
+        self.assertEqual(get_list_status(), 304)
+        owner.first_name = "Changed"
+        owner.save()
+        self.assertEqual(get_list_status(), 200)
+        etag = self.client.get(
+            reverse("book_list"), HTTP_X_REQUESTED_WITH="XMLHttpRequest"
+        )["ETag"]
+        Avatar.objects.create(user=owner, avatar="avatars/owner.png")
+        self.assertEqual(get_list_status(), 200)
+
+    def test_chapter_updates_book(self):
+        book = create_book(self.user, "Book")
+        chapter = create_chapter(book, "Chapter", 1)
+        other_book = create_book(self.user, "Other Book")
+        books = self.get_list().json()["books"]
+        self.assertEqual(
+            [book["title"] for book in books], ["Other Book", "Book"]
+        )
+        chapter.text.title = "Changed Chapter"
+        chapter.text.save()
+        book.refresh_from_db()
+        other_book.refresh_from_db()
+        self.assertEqual(book.content_updated, chapter.text.updated)
+        self.assertGreater(book.content_updated, other_book.content_updated)
+        books = self.get_list().json()["books"]
+        self.assertEqual(
+            [book["title"] for book in books], ["Book", "Other Book"]
+        )
+        self.assertEqual(books[0]["chapters"][0]["title"], "Changed Chapter")
+
+    def test_cover_images_query_count(self):
+        for i in range(2):
+            book = Book.objects.create(
+                title=f"Book {i}",
+                owner=self.owner,
+                cover_image=create_image(self.owner),
+            )
+            share_book(book, self.user)
+        query_count, json = self.count_list_queries()
+        self.assertTrue(
+            all("cover_image_data" in book for book in json["books"])
+        )
+        for i in range(2, 6):
+            book = Book.objects.create(
+                title=f"Book {i}",
+                owner=self.owner,
+                cover_image=create_image(self.owner),
+            )
+            share_book(book, self.user)
+        more_query_count, json = self.count_list_queries()
+        self.assertEqual(len(json["books"]), 6)
+        self.assertTrue(
+            all(
+                book["cover_image_data"]["thumbnail"] for book in json["books"]
+            )
+        )
+        self.assertEqual(query_count, more_query_count)
+
+
+class BookVisibilityQueryPlanTest(TestCase):
+    def setUp(self):
+        self.user = create_user("testuser", "testuser@example.com", "password")
+        owner = create_user("owner", "owner@example.com", "password")
+        for i in range(20):
+            create_book(self.user, f"Book {i}")
+            share_book(create_book(owner, f"Shared book {i}"), self.user)
+
+    def test_single_lookup(self):
+        sql = str(visible_books(self.user).query).upper()
+        self.assertNotIn("DISTINCT", sql)
+        self.assertNotIn(" OR ", sql)
+        self.assertNotIn("DJANGO_CONTENT_TYPE", sql)
+        self.assertNotIn("BOOK_BOOKACCESSRIGHT", sql)
+        self.assertEqual(visible_books(self.user).count(), 40)
+
+    @skipUnless(connection.vendor == "sqlite", "SQLite query plan")
+    def test_sqlite_query_plan(self):
+        plan = visible_books(self.user).explain()
+        self.assertIn("book_bookvisibility USING", plan)
+        self.assertNotIn("SCAN book_bookvisibility", plan)
+
+    @skipUnless(connection.vendor == "postgresql", "PostgreSQL query plan")
+    def test_postgresql_query_plan(self):
+        with connection.cursor() as cursor:
+            # The tables are too small for the planner to prefer indexes on
+            # its own.
+            cursor.execute("SET LOCAL enable_seqscan TO off")
+        plan = visible_books(self.user).explain()
+        self.assertIn("book_bookvisibility", plan)
+        self.assertNotIn("Seq Scan", plan)
+
+
+class BookStylesTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.user = create_user("testuser", "testuser@example.com", "password")
+        self.client.login(username="testuser@example.com", password="password")
+
+    def get_styles(self, etag=None):
+        headers = {"HTTP_X_REQUESTED_WITH": "XMLHttpRequest"}
+        if etag:
+            headers["HTTP_IF_NONE_MATCH"] = etag
+        return self.client.get(reverse("book_styles"), **headers)
+
+    def test_styles_etag(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            BookStyle.objects.create(title="Style", slug="style", contents="")
+        response = self.get_styles()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("style", [s["slug"] for s in response.json()["styles"]])
+        etag = response["ETag"]
+        self.assertEqual(self.get_styles(etag).status_code, 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            BookStyle.objects.filter(slug="style").first().delete()
+        response = self.get_styles(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(
+            "style", [s["slug"] for s in response.json()["styles"]]
+        )
+
+    def test_styles_changed_by_other_process(self):
+        style = BookStyle.objects.create(
+            title="Style", slug="style", contents=""
+        )
+        etag = self.get_styles()["ETag"]
+        # Another process changes the style. The cache of this process is
+        # not cleared, but the version in the database has changed.
+        BookStyle.objects.filter(id=style.id).update(title="Changed")
+        BookStylesVersion.objects.update(version=F("version") + 1)
+        response = self.get_styles(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            "Changed", [s["title"] for s in response.json()["styles"]]
+        )
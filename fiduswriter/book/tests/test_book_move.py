@@ -0,0 +1,111 @@
+from django.db import connection
+from django.test import TestCase, Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from book.models import Book, BookAccessRight, BookChange, BookVisibility
+from .helpers import create_user, create_book, share_book
+
+
+class BookMoveFolderTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = create_user("testuser", "testuser@example.com", "password")
+        self.client.login(username="testuser@example.com", password="password")
+        self.other_user = create_user("other", "other@example.com", "password")
+
+    def move_folder(self, old_path, new_path):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                reverse("book_move_folder"),
+                {"old_path": old_path, "new_path": new_path},
+                HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+            )
+        return response, len(queries)
+
+    def create_book(self, path, owner=None):
+        return Book.objects.create(
+            title="Book", owner=owner or self.user, path=path
+        )
+
+    def test_move_folder(self):
+        moved = self.create_book("/Folder/Book")
+        moved_sub = self.create_book("/Folder/Sub/")
+        not_moved = self.create_book("/Folder 2/Book")
+        other_book = self.create_book("/Folder/Book", self.other_user)
+        shared = share_book(
+            self.create_book("", self.other_user),
+            self.user,
+            path="/Folder/Shared",
+        )
+        other_share = share_book(
+            self.create_book("", self.other_user),
+            create_user("third", "third@example.com", "password"),
+            path="/Folder/Shared",
+        )
+        BookChange.objects.all().delete()
+        response, _query_count = self.move_folder("/Folder/", "/New/Place/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"books": 2, "access_rights": 1})
+        paths = dict(Book.objects.values_list("id", "path"))
+        self.assertEqual(paths[moved.id], "/New/Place/Book")
+        self.assertEqual(paths[moved_sub.id], "/New/Place/Sub/")
+        self.assertEqual(paths[not_moved.id], "/Folder 2/Book")
+        self.assertEqual(paths[other_book.id], "/Folder/Book")
+        self.assertEqual(
+            BookAccessRight.objects.get(id=shared.id).path, "/New/Place/Shared"
+        )
+        self.assertEqual(
+            BookAccessRight.objects.get(id=other_share.id).path,
+            "/Folder/Shared",
+        )
+        self.assertEqual(
+            set(BookChange.objects.values_list("book_id", "user_id")),
+            {
+                (book_id, self.user.id)
+                for book_id in [moved.id, moved_sub.id, shared.book_id]
+            },
+        )
+
+    def test_move_folder_exact_prefix(self):
+        moved = self.create_book("/Foo/a")
+        moved_without_slash = self.create_book("Foo/b")
+        other_case = self.create_book("/foo/c")
+        response, _query_count = self.move_folder("/Foo/", "/Bar/")
+        self.assertEqual(response.json(), {"books": 2, "access_rights": 0})
+        paths = dict(Book.objects.values_list("id", "path"))
+        self.assertEqual(paths[moved.id], "/Bar/a")
+        self.assertEqual(paths[moved_without_slash.id], "/Bar/b")
+        self.assertEqual(paths[other_case.id], "/foo/c")
+        self.assertEqual(
+            set(
+                BookVisibility.objects.filter(user=self.user).values_list(
+                    "path", flat=True
+                )
+            ),
+            {"/Bar/a", "/Bar/b", "/foo/c"},
+        )
+
+    def test_move_folder_invalid_path(self):
+        response, _query_count = self.move_folder("Folder", "/New/")
+        self.assertEqual(response.status_code, 400)
+
+    def test_move_folder_query_count(self):
+        for i in range(2):
+            self.create_book(f"/Small/Book {i}")
+            share_book(
+                create_book(self.other_user, "Book"),
+                self.user,
+                path=f"/Small/Shared {i}",
+            )
+        _response, query_count = self.move_folder("/Small/", "/Small 2/")
+        for i in range(20):
+            self.create_book(f"/Large/Book {i}")
+            share_book(
+                create_book(self.other_user, "Book"),
+                self.user,
+                path=f"/Large/Shared {i}",
+            )
+        response, large_query_count = self.move_folder("/Large/", "/Large 2/")
+        self.assertEqual(response.json(), {"books": 20, "access_rights": 20})
+        self.assertEqual(large_query_count, query_count)
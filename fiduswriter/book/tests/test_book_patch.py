@@ -0,0 +1,255 @@
+import json
+
+from django.db import connection
+from django.test import TestCase, Client, SimpleTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from book.helpers import apply_json_patch
+from book.models import Book, BookAccessRight
+from .helpers import create_user, create_book, create_chapter, share_book
+
+
+class ApplyJsonPatchTest(SimpleTestCase):
+    def test_operations(self):
+        value = {"a": 1, "b": {"c": [1, 2]}, "d/e": 0}
+        value = apply_json_patch(
+            value,
+            [
+                {"op": "replace", "path": "/a", "value": 2},
+                {"op": "add", "path": "/b/c/-", "value": 3},
+                {"op": "add", "path": "/b/c/0", "value": 0},
+                {"op": "remove", "path": "/d~1e"},
+                {"op": "add", "path": "/f", "value": {}},
+            ],
+        )
+        self.assertEqual(value, {"a": 2, "b": {"c": [0, 1, 2, 3]}, "f": {}})
+        self.assertEqual(
+            apply_json_patch(
+                value, [{"op": "replace", "path": "", "value": 1}]
+            ),
+            1,
+        )
+
+    def test_invalid_operations(self):
+        for operation in (
+            {"op": "move", "path": "/a", "from": "/b"},
+            {"op": "replace", "path": "/missing", "value": 1},
+            {"op": "remove", "path": "/missing"},
+            {"op": "add", "path": "/a/b", "value": 1},
+            {"op": "add", "path": "/list/5", "value": 1},
+            {"op": "add", "path": "/a"},
+        ):
+            with self.assertRaises(ValueError):
+                apply_json_patch({"a": 1, "list": []}, [operation])
+
+
+class BookPatchTest(TestCase):
+    fixtures = [
+        "initial_documenttemplates.json",
+    ]
+
+    def setUp(self):
+        self.client = Client()
+        self.user = create_user("testuser", "testuser@example.com", "password")
+        self.client.login(username="testuser@example.com", password="password")
+        self.book = create_book(self.user, "Book")
+        Book.objects.filter(id=self.book.id).update(
+            metadata={"author": "Author", "keywords": ""},
+            settings={"language": "en-US", "papersize": "octavo"},
+        )
+        self.chapters = [
+            create_chapter(self.book, f"Chapter {i}", i) for i in range(1, 4)
+        ]
+
+    def patch(self, changes, book=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                reverse("book_patch"),
+                {"id": (book or self.book).id, "patch": json.dumps(changes)},
+                HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+            )
+        self.queries = [query["sql"] for query in queries]
+        return response
+
+    def current_chapters(self):
+        return [
+            (chapter.text_id, chapter.number, chapter.part)
+            for chapter in self.book.chapter_set.order_by("number")
+        ]
+
+    def test_title(self):
+        response = self.patch({"title": "New title"})
+        self.assertEqual(response.status_code, 200)
+        book = Book.objects.get(id=self.book.id)
+        self.assertEqual(book.title, "New title")
+        self.assertEqual(book.metadata["author"], "Author")
+        self.assertGreater(book.updated, self.book.updated)
+        # Only the title is written and the chapters are not compared.
+        updates = [
+            query
+            for query in self.queries
+            if query.startswith('UPDATE "book_book" SET "title"')
+        ]
+        self.assertEqual(len(updates), 1)
+        self.assertNotIn('"metadata"', updates[0])
+        self.assertNotIn('"settings"', updates[0])
+        self.assertFalse(
+            [query for query in self.queries if '"book_chapter"' in query]
+        )
+
+    def test_metadata_and_settings(self):
+        response = self.patch(
+            {
+                "metadata": [
+                    {"op": "replace", "path": "/keywords", "value": "a, b"}
+                ],
+                "settings": [
+                    {"op": "replace", "path": "/language", "value": "de-DE"}
+                ],
+            }
+        )
+        self.assertEqual(response.status_code, 200)
+        book = Book.objects.get(id=self.book.id)
+        self.assertEqual(
+            book.metadata, {"author": "Author", "keywords": "a, b"}
+        )
+        self.assertEqual(
+            book.settings, {"language": "de-DE", "papersize": "octavo"}
+        )
+
+    def test_chapters(self):
+        new_chapter = create_chapter(create_book(self.user, "Other"), "New", 1)
+        response = self.patch(
+            {
+                "chapters": [
+                    {"op": "remove", "text": self.chapters[0].text_id},
+                    {
+                        "op": "update",
+                        "text": self.chapters[2].text_id,
+                        "number": 1,
+                        "part": "Part",
+                    },
+                    {
+                        "op": "add",
+                        "text": new_chapter.text_id,
+                        "number": 4,
+                        "part": "",
+                    },
+                ]
+            }
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            self.current_chapters(),
+            [
+                (self.chapters[2].text_id, 1, "Part"),
+                (self.chapters[1].text_id, 2, ""),
+                (new_chapter.text_id, 4, ""),
+            ],
+        )
+
+    def test_invalid_patch(self):
+        self.new_text_id = create_chapter(
+            create_book(self.user, "Other"), "New", 1
+        ).text_id
+        for changes in (
+            {"metadata": [{"op": "remove", "path": "/missing"}]},
+            {"chapters": [{"op": "add", "text": self.chapters[0].text_id}]},
+            {"chapters": [{"op": "remove", "text": 0}]},
+            {"docx_template": "template.docx"},
+            {"metadata": {"a": 1}},
+            {"metadata": ["replace"]},
+            {"settings": [{"op": "add", "path": 1, "value": 1}]},
+            {"chapters": {"op": "add"}},
+            {"chapters": [{"op": "add"}]},
+            {"chapters": [{"op": "add", "text": self.new_text_id}]},
+            {
+                "chapters": [
+                    {"op": "add", "text": self.new_text_id, "number": "1"}
+                ]
+            },
+            {"chapters": [{"op": "add", "text": 0, "number": 1}]},
+            {"title": None},
+            {"version": "1"},
+            {"cover_image": "image"},
+        ):
+            response = self.patch(dict({"title": "Changed"}, **changes))
+            self.assertEqual(response.status_code, 400, changes)
+        self.assertEqual(Book.objects.get(id=self.book.id).title, "Book")
+        self.assertEqual(len(self.current_chapters()), 3)
+
+    def test_version(self):
+        response = self.patch({"title": "First", "version": 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["version"], 2)
+        response = self.patch(
+            {"title": "Second", "path": "/folder/", "version": 1}
+        )
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["book"]["title"], "First")
+        self.assertEqual(response.json()["book"]["version"], 2)
+        book = Book.objects.get(id=self.book.id)
+        self.assertEqual((book.title, book.path), ("First", ""))
+        # Without a version, the book is saved based on its current version.
+        response = self.patch({"title": "Third"})
+        self.assertEqual(response.json()["version"], 3)
+
+    def test_version_unchanged_book(self):
+        # Nothing of the book changes, so the version stays the same.
+        response = self.patch({"version": 1})
+        self.assertEqual(response.json()["version"], 1)
+        owner = create_user("owner", "owner@example.com", "password")
+        book = create_book(owner, "Shared")
+        share_book(book, self.user, "write")
+        response = self.patch({"path": "/shared/", "version": 1}, book)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["version"], 1)
+        self.assertEqual(Book.objects.get(id=book.id).version, 1)
+
+    def test_version_in_book_list(self):
+        collaborator = create_user(
+            "collaborator", "collaborator@example.com", "password"
+        )
+        share_book(self.book, collaborator, "write")
+        client = Client()
+        client.login(username="collaborator@example.com", password="password")
+        list_version = client.post(
+            reverse("book_list"), HTTP_X_REQUESTED_WITH="XMLHttpRequest"
+        ).json()["version"]
+        self.patch({"title": "Changed", "version": 1})
+        delta = client.post(
+            reverse("book_list"),
+            {"since": list_version},
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+        ).json()
+        self.assertEqual(
+            [(book["title"], book["version"]) for book in delta["books"]],
+            [("Changed", 2)],
+        )
+        # The collaborator can save based on the new version.
+        response = client.post(
+            reverse("book_patch"),
+            {
+                "id": self.book.id,
+                "patch": json.dumps({"title": "Again", "version": 2}),
+            },
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+        )
+        self.assertEqual(response.json()["version"], 3)
+
+    def test_access(self):
+        owner = create_user("owner", "owner@example.com", "password")
+        book = create_book(owner, "Shared")
+        self.assertEqual(self.patch({"title": "X"}, book).status_code, 403)
+        access_right = share_book(book, self.user, "read")
+        self.assertEqual(self.patch({"title": "X"}, book).status_code, 403)
+        access_right.rights = "write"
+        access_right.save()
+        response = self.patch({"title": "X", "path": "/shared/"}, book)
+        self.assertEqual(response.status_code, 200)
+        book = Book.objects.get(id=book.id)
+        self.assertEqual((book.title, book.path), ("X", ""))
+        self.assertEqual(
+            BookAccessRight.objects.get(id=access_right.id).path, "/shared/"
+        )
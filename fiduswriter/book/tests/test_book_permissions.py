@@ -0,0 +1,118 @@
+import json
+
+from django.core.cache import cache
+from django.db import connection
+from django.http import HttpRequest
+from django.test import TestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from book.helpers import get_book_rights, is_book_owner
+from book.models import Book
+from .helpers import create_user, create_book, share_book
+
+
+class BookPermissionsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.owner = create_user("owner", "owner@example.com", "password")
+        self.user = create_user("testuser", "testuser@example.com", "password")
+        self.book = create_book(self.owner, "Book")
+        self.access_right = share_book(self.book, self.user, "write")
+
+    def request(self, user):
+        request = HttpRequest()
+        request.user = user
+        return request
+
+    def permission_queries(self, user):
+        with CaptureQueriesContext(connection) as queries:
+            request = self.request(user)
+            rights = get_book_rights(request, self.book.id)
+            owner = is_book_owner(request, self.book.id)
+            self.assertEqual(get_book_rights(request, self.book.id), rights)
+        return rights, owner, len(queries)
+
+    def test_request_scope(self):
+        self.assertEqual(
+            self.permission_queries(self.owner), ("write", True, 1)
+        )
+        self.assertEqual(
+            self.permission_queries(self.user), ("write", False, 1)
+        )
+        other_user = create_user("other", "other@example.com", "password")
+        self.assertEqual(self.permission_queries(other_user), (None, False, 1))
+
+    @override_settings(BOOK_PERMISSIONS_CACHE_TIMEOUT=60)
+    def test_cross_request_cache(self):
+        self.assertEqual(
+            self.permission_queries(self.user), ("write", False, 1)
+        )
+        self.assertEqual(
+            self.permission_queries(self.user), ("write", False, 0)
+        )
+        self.assertEqual(
+            self.permission_queries(self.owner), ("write", True, 0)
+        )
+        # Changes of the access rights invalidate the cache.
+        self.access_right.rights = "read"
+        self.access_right.save()
+        self.assertEqual(
+            self.permission_queries(self.user), ("read", False, 1)
+        )
+        self.access_right.delete()
+        self.assertEqual(self.permission_queries(self.user), (None, False, 1))
+        # So do changes of the owner.
+        book = Book.objects.get(id=self.book.id)
+        book.owner = self.user
+        book.save()
+        self.assertEqual(
+            self.permission_queries(self.user), ("write", True, 1)
+        )
+        book.delete()
+        self.assertEqual(self.permission_queries(self.user), (None, False, 1))
+
+    def save_book(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                reverse("book_save"),
+                {
+                    "book": json.dumps(
+                        {
+                            "id": self.book.id,
+                            "title": "Changed",
+                            "path": "",
+                            "metadata": {},
+                            "settings": self.book.settings,
+                            "chapters": [],
+                        }
+                    )
+                },
+                HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+            )
+        self.assertEqual(response.status_code, 201)
+        return [query["sql"] for query in queries]
+
+    def table_queries(self, queries, table):
+        return [
+            query
+            for query in queries
+            if query.startswith("SELECT") and f'FROM "{table}"' in query
+        ]
+
+    def test_save_queries(self):
+        self.client.login(username="owner@example.com", password="password")
+        queries = self.save_book()
+        # One lookup decides about the access, the owner is not loaded.
+        self.assertEqual(
+            len(self.table_queries(queries, "book_bookvisibility")), 1
+        )
+        self.assertEqual(len(self.table_queries(queries, "user_user")), 1)
+        with override_settings(BOOK_PERMISSIONS_CACHE_TIMEOUT=60):
+            self.save_book()
+            cached_queries = self.save_book()
+        self.assertEqual(
+            len(self.table_queries(cached_queries, "book_bookvisibility")), 0
+        )
+        self.assertEqual(len(cached_queries), len(queries) - 1)
@@ -0,0 +1,257 @@
+import json
+
+from django.db import connection
+from django.test import TestCase, Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from book.models import Book
+from document.models import AccessRight
+from .helpers import create_user, create_book, create_chapter, share_book
+
+
+class BookSaveTest(TestCase):
+    fixtures = [
+        "initial_documenttemplates.json",
+    ]
+
+    def setUp(self):
+        self.client = Client()
+        self.user = create_user("testuser", "testuser@example.com", "password")
+        self.client.login(username="testuser@example.com", password="password")
+        self.book = create_book(self.user, "Book")
+        self.chapters = [
+            create_chapter(self.book, f"Chapter {i}", i) for i in range(1, 11)
+        ]
+
+    def book_data(self, chapters):
+        return {
+            "id": self.book.id,
+            "title": self.book.title,
+            "path": self.book.path,
+            "metadata": self.book.metadata,
+            "settings": self.book.settings,
+            "chapters": chapters,
+        }
+
+    def save_book(self, book_data):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                reverse("book_save"),
+                {"book": json.dumps(book_data)},
+                HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+            )
+        self.assertEqual(response.status_code, 201)
+        return [query["sql"] for query in queries]
+
+    def chapter_queries(self, queries, statement):
+        return [
+            query
+            for query in queries
+            if query.startswith(statement) and '"book_chapter"' in query
+        ]
+
+    def current_chapters(self):
+        return [
+            {"text": chapter.text_id, "number": chapter.number, "part": ""}
+            for chapter in Book.objects.get(id=self.book.id)
+            .chapter_set.all()
+            .order_by("number")
+        ]
+
+    def test_reorder_chapters(self):
+        chapters = self.current_chapters()
+        chapters[0]["number"], chapters[1]["number"] = 2, 1
+        queries = self.save_book(self.book_data(chapters))
+        self.assertEqual(len(self.chapter_queries(queries, "INSERT")), 0)
+        self.assertEqual(len(self.chapter_queries(queries, "DELETE")), 0)
+        self.assertEqual(len(self.chapter_queries(queries, "UPDATE")), 1)
+        self.assertEqual(
+            self.current_chapters(),
+            sorted(chapters, key=lambda c: c["number"]),
+        )
+
+    def test_replace_chapter(self):
+        chapters = self.current_chapters()
+        removed_chapter = chapters.pop()
+        new_chapter = create_chapter(create_book(self.user, "Other"), "New", 1)
+        chapters.append(
+            {"text": new_chapter.text_id, "number": 10, "part": "Part"}
+        )
+        queries = self.save_book(self.book_data(chapters))
+        self.assertEqual(len(self.chapter_queries(queries, "INSERT")), 1)
+        self.assertEqual(len(self.chapter_queries(queries, "DELETE")), 1)
+        self.assertEqual(len(self.chapter_queries(queries, "UPDATE")), 0)
+        current_chapters = self.current_chapters()
+        self.assertNotIn(removed_chapter, current_chapters)
+        self.assertEqual(current_chapters[-1]["text"], new_chapter.text_id)
+
+    def test_unchanged_chapters(self):
+        queries = self.save_book(self.book_data(self.current_chapters()))
+        self.assertEqual(
+            len([query for query in queries if '"book_chapter"' in query]),
+            1,
+        )
+
+    def test_new_chapter_access_rights(self):
+        collaborators = [
+            create_user(f"collaborator{i}", f"c{i}@example.com", "password")
+            for i in range(3)
+        ]
+        for collaborator in collaborators:
+            share_book(self.book, collaborator)
+        other_book = create_book(self.user, "Other")
+        new_chapters = [
+            create_chapter(other_book, f"New {i}", i) for i in range(1, 3)
+        ]
+        chapters = self.current_chapters() + [
+            {"text": chapter.text_id, "number": 11 + i, "part": ""}
+            for i, chapter in enumerate(new_chapters)
+        ]
+        queries = self.save_book(self.book_data(chapters))
+        self.assertEqual(
+            len(
+                [
+                    query
+                    for query in queries
+                    if query.startswith("INSERT")
+                    and '"document_accessright"' in query
+                ]
+            ),
+            1,
+        )
+        for chapter in new_chapters:
+            self.assertEqual(
+                {
+                    (access_right.holder_id, access_right.rights)
+                    for access_right in AccessRight.objects.filter(
+                        document_id=chapter.text_id
+                    )
+                },
+                {(collaborator.id, "read") for collaborator in collaborators},
+            )
+        # Saving again does not create duplicates.
+        self.save_book(self.book_data(chapters))
+        self.assertEqual(
+            AccessRight.objects.filter(
+                document_id__in=[chapter.text_id for chapter in new_chapters]
+            ).count(),
+            6,
+        )
+
+    def test_new_chapter_owner_access_right(self):
+        collaborator = create_user(
+            "collaborator", "collaborator@example.com", "password"
+        )
+        share_book(self.book, collaborator, "write")
+        chapter = create_chapter(
+            create_book(collaborator, "Collaborator Book"), "Chapter", 1
+        )
+        self.client.login(
+            username="collaborator@example.com", password="password"
+        )
+        chapters = self.current_chapters() + [
+            {"text": chapter.text_id, "number": 11, "part": ""}
+        ]
+        self.save_book(self.book_data(chapters))
+        self.assertTrue(
+            AccessRight.objects.filter(
+                document_id=chapter.text_id,
+                holder_id=self.user.id,
+                rights="read",
+            ).exists()
+        )
+
+    def test_version(self):
+        self.assertEqual(self.book.version, 1)
+        data = dict(self.book_data(self.current_chapters()), version=1)
+        response = self.client.post(
+            reverse("book_save"),
+            {"book": json.dumps(dict(data, title="First"))},
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()["version"], 2)
+        # A save based on the old version is rejected with the current state
+        # of the book.
+        response = self.client.post(
+            reverse("book_save"),
+            {"book": json.dumps(dict(data, title="Second", chapters=[]))},
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+        )
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["book"]["title"], "First")
+        self.assertEqual(response.json()["book"]["version"], 2)
+        book = Book.objects.get(id=self.book.id)
+        self.assertEqual((book.title, book.version), ("First", 2))
+        self.assertEqual(book.chapter_set.count(), 10)
+
+
+class BookChangeTrackingTest(TestCase):
+    def setUp(self):
+        self.user = create_user("testuser", "testuser@example.com", "password")
+        Book.objects.filter(id=create_book(self.user, "Book").id).update(
+            metadata={"author": "Author", "keywords": ["a", "b"]}
+        )
+        self.book = Book.objects.get(title="Book")
+
+    def save(self, book):
+        with CaptureQueriesContext(connection) as queries:
+            book.save()
+        return [
+            query["sql"]
+            for query in queries
+            if query["sql"].startswith('UPDATE "book_book"')
+        ]
+
+    def test_unchanged(self):
+        self.book.metadata = {"keywords": ["a", "b"], "author": "Author"}
+        self.assertEqual(self.book.dirty_fields(), [])
+        self.assertFalse(self.book.has_changed())
+        self.assertEqual(self.save(self.book), [])
+
+    def test_changed_json(self):
+        self.book.metadata["keywords"].append("c")
+        self.assertEqual(self.book.dirty_fields(), ["metadata"])
+        self.assertTrue(self.book.has_changed())
+        updates = self.save(self.book)
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"metadata"', updates[0])
+        self.assertIn('"content_updated"', updates[0])
+        self.assertNotIn('"title"', updates[0])
+        self.assertEqual(
+            Book.objects.get(id=self.book.id).metadata["keywords"],
+            ["a", "b", "c"],
+        )
+        # Once saved, the book is clean again.
+        self.assertEqual(self.book.dirty_fields(), [])
+
+    def test_path_is_not_content(self):
+        self.book.path = "/folder/"
+        self.assertFalse(self.book.has_changed())
+        updates = self.save(self.book)
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"path"', updates[0])
+        self.assertNotIn('"content_updated"', updates[0])
+
+    def test_deferred_fields(self):
+        book = Book.objects.only("id", "title").get(id=self.book.id)
+        self.assertEqual(book.dirty_fields(), [])
+        book.title = "New title"
+        self.assertTrue(book.has_changed())
+        self.save(book)
+        book = Book.objects.only("id", "metadata").get(id=self.book.id)
+        # Loading a deferred field does not make it dirty.
+        book.title
+        self.assertEqual(book.dirty_fields(), [])
+        self.assertEqual(book.title, "New title")
+
+    def test_copy_by_resetting_pk(self):
+        self.book.pk = None
+        self.book.title = "Copy"
+        self.book.save()
+        self.assertIsNotNone(self.book.pk)
+        copy = Book.objects.get(pk=self.book.pk)
+        self.assertEqual(copy.title, "Copy")
+        self.assertEqual(copy.metadata["author"], "Author")
+        self.assertEqual(Book.objects.count(), 2)
@@ -0,0 +1,185 @@
+import json
+from io import StringIO
+
+from django.core.management import call_command
+from django.http import HttpRequest
+from django.test import TestCase, Client
+from django.urls import reverse
+
+from book.helpers import get_book_rights
+from book.models import Book, BookAccessRight, BookChange, BookVisibility
+from user.models import UserInvite
+from .helpers import create_user, create_book, share_book
+
+
+class BookVisibilityTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = create_user("testuser", "testuser@example.com", "password")
+        self.collaborator = create_user(
+            "collaborator", "collaborator@example.com", "password"
+        )
+        self.client.login(username="testuser@example.com", password="password")
+        self.book = create_book(self.user, "Book")
+
+    def visibility(self, book=None):
+        return {
+            (visibility.user_id, visibility.rights, visibility.path)
+            for visibility in BookVisibility.objects.filter(
+                book=book or self.book
+            )
+        }
+
+    def test_owner(self):
+        self.assertEqual(self.visibility(), {(self.user.id, "write", "")})
+        Book.objects.filter(id=self.book.id).update(path="/folder/")
+        book = Book.objects.get(id=self.book.id)
+        book.owner = self.collaborator
+        book.save()
+        self.assertEqual(
+            self.visibility(), {(self.collaborator.id, "write", "/folder/")}
+        )
+
+    def test_access_rights(self):
+        access_right = share_book(self.book, self.collaborator, "read", "/a/")
+        self.assertIn((self.collaborator.id, "read", "/a/"), self.visibility())
+        access_right.rights = "write"
+        access_right.save()
+        self.assertIn(
+            (self.collaborator.id, "write", "/a/"), self.visibility()
+        )
+        access_right.delete()
+        self.assertEqual(self.visibility(), {(self.user.id, "write", "")})
+
+    def test_access_right_new_holder(self):
+        other = create_user("other", "other@example.com", "password")
+        other_book = create_book(self.user, "Other")
+        access_right = share_book(self.book, self.collaborator, "write")
+        access_right.holder_id = other.id
+        access_right.save()
+        # The previous holder loses the access.
+        self.assertEqual(
+            self.visibility(),
+            {(self.user.id, "write", ""), (other.id, "write", "")},
+        )
+        request = HttpRequest()
+        request.user = self.collaborator
+        self.assertIsNone(get_book_rights(request, self.book.id))
+        access_right.book = other_book
+        access_right.save()
+        self.assertEqual(self.visibility(), {(self.user.id, "write", "")})
+        self.assertIn((other.id, "write", ""), self.visibility(other_book))
+        self.assertEqual(
+            set(
+                BookChange.objects.filter(book_id=self.book.id).values_list(
+                    "user_id", flat=True
+                )
+            ),
+            {self.user.id, self.collaborator.id, other.id},
+        )
+
+    def test_access_right_other_users(self):
+        others = [
+            create_user(f"other{i}", f"other{i}@example.com", "password")
+            for i in range(3)
+        ]
+        for other in others:
+            share_book(self.book, other, "read")
+        access_right = share_book(self.book, self.collaborator, "read")
+        row_ids = dict(
+            BookVisibility.objects.filter(book=self.book).values_list(
+                "user_id", "id"
+            )
+        )
+        access_right.rights = "write"
+        access_right.save()
+        access_right.delete()
+        # Only the row of the collaborator is written, the rows of the owner
+        # and the other users are kept as they are.
+        del row_ids[self.collaborator.id]
+        self.assertEqual(
+            dict(
+                BookVisibility.objects.filter(book=self.book).values_list(
+                    "user_id", "id"
+                )
+            ),
+            row_ids,
+        )
+        book = Book.objects.get(id=self.book.id)
+        book.path = "/folder/"
+        book.save()
+        self.assertIn((self.user.id, "write", "/folder/"), self.visibility())
+        self.assertEqual(
+            dict(
+                BookVisibility.objects.filter(book=self.book).values_list(
+                    "user_id", "id"
+                )
+            ),
+            row_ids,
+        )
+
+    def test_save_access_rights(self):
+        response = self.client.post(
+            reverse("save_access_rights"),
+            {
+                "book_ids": json.dumps([self.book.id]),
+                "access_rights": json.dumps(
+                    [
+                        {
+                            "holder": {
+                                "id": self.collaborator.id,
+                                "type": "user",
+                            },
+                            "rights": "write",
+                        }
+                    ]
+                ),
+            },
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest",
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            self.visibility(),
+            {(self.user.id, "write", ""), (self.collaborator.id, "write", "")},
+        )
+
+    def test_invite(self):
+        invited_user = create_user(
+            "invited", "invited@example.com", "password"
+        )
+        invite = UserInvite.objects.create(
+            email=invited_user.email,
+            username=invited_user.username,
+            by=self.user,
+            to=invited_user,
+        )
+        share_book(self.book, invite, "write")
+        self.assertEqual(self.visibility(), {(self.user.id, "write", "")})
+        invite._apply = True
+        invite.delete()
+        self.assertIn((invited_user.id, "write", ""), self.visibility())
+
+    def test_delete_book(self):
+        share_book(self.book, self.collaborator)
+        self.book.delete()
+        self.assertFalse(BookVisibility.objects.exists())
+
+    def test_rebuild(self):
+        other_book = create_book(self.collaborator, "Other")
+        share_book(other_book, self.user, "read", "/shared/")
+        expected = {
+            book.id: self.visibility(book) for book in (self.book, other_book)
+        }
+        BookVisibility.objects.all().delete()
+        BookAccessRight.objects.filter(book=other_book).update(path="/moved/")
+        out = StringIO()
+        call_command("rebuild_book_visibility", stdout=out)
+        self.assertIn("Rebuilt the visibility of 2 books", out.getvalue())
+        self.assertEqual(self.visibility(), expected[self.book.id])
+        self.assertEqual(
+            self.visibility(other_book),
+            {
+                (self.collaborator.id, "write", ""),
+                (self.user.id, "read", "/moved/"),
+            },
+        )
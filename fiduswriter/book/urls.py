@@ -4,10 +4,21 @@ from . import views
 
 urlpatterns = [
     re_path("^list/$", views.list, name="book_list"),
+    re_path("^styles/$", views.styles, name="book_styles"),
+    re_path("^folders/$", views.folders, name="book_folders"),
     re_path("^save/$", views.save, name="book_save"),
+    re_path("^patch/$", views.patch, name="book_patch"),
     re_path("^copy/$", views.copy, name="book_copy"),
+    re_path("^copy/bulk/$", views.copy_bulk, name="book_copy_bulk"),
+    re_path("^copy/deep/$", views.copy_deep, name="book_copy_deep"),
+    re_path(
+        "^copy/job/(?P<job_id>[0-9]+)/$",
+        views.copy_job,
+        name="book_copy_job",
+    ),
     re_path("^delete/$", views.delete, name="book_delete"),
     re_path("^move/$", views.move, name="book_move"),
+    re_path("^move/folder/$", views.move_folder, name="book_move_folder"),
     re_path(
         "^access_rights/get/$",
         views.get_access_rights,
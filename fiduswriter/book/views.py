@@ -1,24 +1,71 @@
+import base64
+import hashlib
 import json
 import time
+from collections import defaultdict
+from datetime import datetime
 
 from django.http import JsonResponse, HttpRequest
 from django.contrib.auth.decorators import login_required
 from django.db import transaction
-from django.contrib.auth import get_user_model
-from django.views.decorators.http import require_POST
-from django.db.models import Q, Prefetch
+from django.utils import timezone
+from django.contrib.contenttypes.models import ContentType
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import (
+    condition,
+    require_http_methods,
+    require_POST,
+)
+from django.db.models import (
+    Case,
+    Count,
+    F,
+    Q,
+    Prefetch,
+    Max,
+    TextField,
+    Value,
+    When,
+)
+from django.db.models.functions import Concat, StrIndex, Substr
 
 from base.decorators import ajax_required
-from document.helpers.serializers import PythonWithURLSerializer
-from .models import Book, BookAccessRight, Chapter, BookStyle
+from .models import (
+    Book,
+    BookAccessRight,
+    BookChange,
+    BookCopyJob,
+    BookVisibility,
+    Chapter,
+)
 from . import emails
+from .helpers import (
+    apply_json_patch,
+    bump_book_list_versions,
+    check_access_rights,
+    check_book_copies,
+    check_chapter_operations,
+    copy_object,
+    defer_book_changes,
+    delete_unused_images,
+    free_paths,
+    get_book_list_version,
+    get_book_rights,
+    get_book_user_ids,
+    get_holders,
+    get_styles,
+    is_book_owner,
+    log_book_changes,
+    prefetch_avatars,
+    update_book_visibility,
+    update_user_book_visibility,
+)
 
 from user.helpers import Avatars
 
-from document.models import AccessRight
+from document.models import AccessRight, Document
 from document.views import documents_list
 from usermedia.models import UserImage
-from user.models import UserInvite
 
 
 @login_required
@@ -32,20 +79,34 @@ def get_access_rights(request):
     book_ids = request.POST.getlist("book_ids[]")
     if len(book_ids) > 0:
         ar_qs = ar_qs.filter(book_id__in=book_ids)
+    ar_list = [ar for ar in ar_qs]
+    holders = get_holders(ar_list)
+    prefetch_avatars(
+        avatars,
+        [
+            holder
+            for (holder_type_id, holder_id), holder in holders.items()
+            if ContentType.objects.get_for_id(holder_type_id).model == "user"
+        ],
+    )
     access_rights = []
-    for ar in ar_qs:
-        if ar.holder_type.model == "user":
-            avatar = avatars.get_url(ar.holder_obj)
+    for ar in ar_list:
+        holder = holders.get((ar.holder_type_id, ar.holder_id))
+        if not holder:
+            continue
+        holder_type = ContentType.objects.get_for_id(ar.holder_type_id)
+        if holder_type.model == "user":
+            avatar = avatars.get_url(holder)
         else:
             avatar = None
         access_rights.append(
             {
-                "book_id": ar.book.id,
+                "book_id": ar.book_id,
                 "rights": ar.rights,
                 "holder": {
                     "id": ar.holder_id,
-                    "type": ar.holder_type.model,
-                    "name": ar.holder_obj.readable_name,
+                    "type": holder_type.model,
+                    "name": holder.readable_name,
                     "avatar": avatar,
                 },
             }
@@ -54,23 +115,45 @@ def get_access_rights(request):
     return JsonResponse(response, status=status)
 
 
-@login_required
-@require_POST
-@ajax_required
-def list(request):
-    response = {}
-    status = 200
-    avatars = Avatars()
-    response["documents"] = documents_list(request)
-    books = (
-        Book.objects.filter(
-            Q(owner=request.user)
-            | Q(
-                bookaccessright__holder_id=request.user.id,
-                bookaccessright__holder_type__model="user",
-            )
-        )
-        .select_related("owner")
+# Default and maximal number of books per page of the paginated book list.
+BOOK_LIST_PAGE_SIZE = 100
+BOOK_LIST_MAX_PAGE_SIZE = 500
+
+
+def encode_list_cursor(book):
+    # The cursor points at the last book of a page. It is opaque to the
+    # client.
+    cursor = json.dumps([book.content_updated.isoformat(), book.id])
+    return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+
+def decode_list_cursor(cursor):
+    try:
+        updated, book_id = json.loads(base64.urlsafe_b64decode(cursor))
+        return datetime.fromisoformat(updated), int(book_id)
+    except (ValueError, TypeError):
+        return None
+
+
+def user_access_rights(user):
+    return BookAccessRight.objects.filter(
+        holder_type=ContentType.objects.get_for_model(user),
+        holder_id=user.id,
+    )
+
+
+def visible_books(user):
+    # The books that the user owns or that have been shared with the user.
+    # There is one visibility per user and book, so no DISTINCT is needed.
+    return Book.objects.filter(bookvisibility__user=user)
+
+
+def books_queryset(user):
+    # The rights and path of the current user are annotated onto each book
+    # from its visibility.
+    return (
+        visible_books(user)
+        .select_related("owner", "cover_image")
         .prefetch_related(
             Prefetch(
                 "chapter_set",
@@ -80,7 +163,6 @@ def list(request):
                     "part",
                     "text_id",
                     "text__title",
-                    "text__updated",
                 ),
             )
         )
@@ -89,10 +171,18 @@ def list(request):
             "title",
             "path",
             "added",
-            "updated",
+            "content_updated",
             "metadata",
             "settings",
-            "cover_image",
+            "version",
+            "cover_image__id",
+            "cover_image__added",
+            "cover_image__checksum",
+            "cover_image__file_type",
+            "cover_image__image",
+            "cover_image__thumbnail",
+            "cover_image__height",
+            "cover_image__width",
             "docx_template",
             "odt_template",
             "owner_id",
@@ -100,79 +190,124 @@ def list(request):
             "owner__last_name",
             "owner__username",
         )
-        .order_by("-updated")
-        .distinct()
+        .annotate(
+            user_rights=F("bookvisibility__rights"),
+            user_path=F("bookvisibility__path"),
+        )
+        .order_by("-content_updated", "-id")
     )
-    response["books"] = []
-    for book in books:
-        if book.owner_id == request.user.id:
-            access_right = "write"
-            path = book.path
-        else:
-            access_right_object = BookAccessRight.objects.get(
-                holder_id=request.user.id, holder_type__model="user", book=book
-            )
-            access_right = access_right_object.rights
-            path = access_right_object.path
-        added = time.mktime(book.added.utctimetuple())
-        updated = time.mktime(book.updated.utctimetuple())
-        is_owner = False
-        if book.owner_id == request.user.id:
-            is_owner = True
-        chapters = []
-        for chapter in book.chapter_set.all():
-            chapters.append(
-                {
-                    "text": chapter.text_id,
-                    "number": chapter.number,
-                    "part": chapter.part,
-                    "title": chapter.text.title,
-                }
-            )
-            chapter_updated = time.mktime(chapter.text.updated.utctimetuple())
-            if chapter_updated > updated:
-                updated = chapter_updated
-        book_data = {
-            "id": book.id,
-            "title": book.title,
-            "path": path,
-            "is_owner": is_owner,
-            "owner": {
-                "id": book.owner_id,
-                "name": book.owner.readable_name,
-                "avatar": avatars.get_url(book.owner),
-            },
-            "added": added,
-            "updated": updated,
-            "rights": access_right,
-            "chapters": chapters,
-            "metadata": book.metadata,
-            "settings": book.settings,
-        }
-        if book.cover_image:
-            image = book.cover_image
-            book_data["cover_image"] = image.id
-            field_obj = {
-                "id": image.id,
-                "added": time.mktime(image.added.utctimetuple()) * 1000,
-                "checksum": image.checksum,
-                "file_type": image.file_type,
-                "title": "",
-                "cats": "",
-                "image": image.image.url,
+
+
+def normalized_path(field):
+    # Paths are treated as if they start with a slash, even if they do not.
+    return Case(
+        When(**{f"{field}__startswith": "/"}, then=F(field)),
+        default=Concat(Value("/"), F(field)),
+        output_field=TextField(),
+    )
+
+
+def in_folder(queryset, path_field, folder):
+    # The objects whose normalized path is in the folder or its subfolders.
+    # The prefix is compared exactly, as LIKE is case-insensitive in SQLite.
+    return (
+        queryset.alias(folder_path=normalized_path(path_field))
+        .alias(folder_prefix=Substr("folder_path", 1, len(folder)))
+        .filter(folder_prefix=folder)
+    )
+
+
+def filter_folder(books, folder):
+    # Only the books directly in the folder, not those in its subfolders.
+    return (
+        in_folder(books, "user_path", folder)
+        .alias(folder_path_rest=Substr("folder_path", len(folder) + 1))
+        .exclude(folder_path_rest__contains="/")
+    )
+
+
+def subfolders(queryset, path_field, updated_field, folder):
+    # The number of books and the latest update in each subfolder of the
+    # folder, aggregated by the database.
+    return (
+        in_folder(queryset, path_field, folder)
+        .alias(folder_path_rest=Substr("folder_path", len(folder) + 1))
+        .alias(slash=StrIndex("folder_path_rest", Value("/")))
+        .filter(slash__gt=0)
+        .annotate(name=Substr("folder_path_rest", 1, F("slash") - 1))
+        .values("name")
+        .annotate(count=Count("id"), updated=Max(updated_field))
+        .order_by()
+    )
+
+
+def serialize_book(book, user, avatars):
+    if book.owner_id == user.id:
+        access_right = "write"
+        path = book.path
+    else:
+        access_right = book.user_rights
+        path = book.user_path
+    added = time.mktime(book.added.utctimetuple())
+    updated = time.mktime(book.content_updated.utctimetuple())
+    is_owner = False
+    if book.owner_id == user.id:
+        is_owner = True
+    chapters = []
+    for chapter in book.chapter_set.all():
+        chapters.append(
+            {
+                "text": chapter.text_id,
+                "number": chapter.number,
+                "part": chapter.part,
+                "title": chapter.text.title,
             }
-            if image.thumbnail:
-                field_obj["thumbnail"] = image.thumbnail.url
-                field_obj["height"] = image.height
-                field_obj["width"] = image.width
-            book_data["cover_image_data"] = field_obj
-        if book.odt_template:
-            book_data["odt_template"] = book.odt_template.url
-        if book.docx_template:
-            book_data["docx_template"] = book.docx_template.url
-        response["books"].append(book_data)
-    response["contacts"] = []
-    for contact in request.user.contacts.all():
+        )
+    book_data = {
+        "id": book.id,
+        "title": book.title,
+        "path": path,
+        "is_owner": is_owner,
+        "owner": {
+            "id": book.owner_id,
+            "name": book.owner.readable_name,
+            "avatar": avatars.get_url(book.owner),
+        },
+        "added": added,
+        "updated": updated,
+        "rights": access_right,
+        "chapters": chapters,
+        "metadata": book.metadata,
+        "settings": book.settings,
+        "version": book.version,
+    }
+    if book.cover_image:
+        image = book.cover_image
+        book_data["cover_image"] = image.id
+        field_obj = {
+            "id": image.id,
+            "added": time.mktime(image.added.utctimetuple()) * 1000,
+            "checksum": image.checksum,
+            "file_type": image.file_type,
+            "title": "",
+            "cats": "",
+            "image": image.image.url,
+        }
+        if image.thumbnail:
+            field_obj["thumbnail"] = image.thumbnail.url
+            field_obj["height"] = image.height
+            field_obj["width"] = image.width
+        book_data["cover_image_data"] = field_obj
+    if book.odt_template:
+        book_data["odt_template"] = book.odt_template.url
+    if book.docx_template:
+        book_data["docx_template"] = book.docx_template.url
+    return book_data
+
+
+def contacts_list(user, avatars):
+    contacts = []
+    for contact in user.contacts.all():
         contact_object = {
             "id": contact.id,
             "name": contact.readable_name,
@@ -180,8 +315,8 @@ def list(request):
             "avatar": avatars.get_url(contact),
             "type": "user",
         }
-        response["contacts"].append(contact_object)
-    for contact in request.user.invites_by.all():
+        contacts.append(contact_object)
+    for contact in user.invites_by.all():
         contact_object = {
             "id": contact.id,
             "name": contact.username,
@@ -189,120 +324,440 @@ def list(request):
             "avatar": None,
             "type": "userinvite",
         }
-        response["contacts"].append(contact_object)
-    serializer = PythonWithURLSerializer()
-    book_styles = serializer.serialize(
-        BookStyle.objects.all(),
-        use_natural_foreign_keys=True,
-        fields=["title", "slug", "contents", "bookstylefile_set"],
-    )
-    response["styles"] = [obj["fields"] for obj in book_styles]
+        contacts.append(contact_object)
+    return contacts
+
+
+def list_params(request):
+    if request.method == "GET":
+        return request.GET
+    return request.POST
+
+
+def list_etag(request):
+    # The ETag only depends on the version of the book list of the user and
+    # the parameters, so unchanged lists can be confirmed without reading any
+    # books or documents.
+    if request.method != "GET":
+        # Conditional POST requests would fail with 412 instead of 304.
+        return None
+    params = sorted(list_params(request).items())
+    params_hash = hashlib.md5(json.dumps(params).encode()).hexdigest()
+    version = get_book_list_version(request.user)
+    return f"{request.user.id}-{version}-{params_hash}"
+
+
+@login_required
+@ajax_required
+@require_http_methods(["GET", "POST"])
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=list_etag)
+def list(request):
+    response = {}
+    status = 200
+    avatars = Avatars()
+    books = books_queryset(request.user)
+    params = list_params(request)
+    page_size = params.get("page_size")
+    cursor = params.get("cursor")
+    since = params.get("since")
+    folder = params.get("folder")
+    if folder:
+        # Only the books in one folder. Combined with pagination, a folder
+        # can be opened without loading the entire book list.
+        if since or not (folder.startswith("/") and folder.endswith("/")):
+            return JsonResponse(response, status=400)
+        books = filter_folder(books, folder)
+    if not cursor:
+        # The version needs to be determined before the books are read so
+        # that changes that happen in the meantime are not lost.
+        response["version"] = get_book_list_version(request.user)
+    if since:
+        # Delta mode. Only books that changed after the given version are
+        # returned. Changed books that the user can no longer see have been
+        # deleted or unshared.
+        try:
+            since = int(since)
+        except ValueError:
+            return JsonResponse(response, status=400)
+        changed_book_ids = set(
+            BookChange.objects.filter(
+                user=request.user, version__gt=since
+            ).values_list("book_id", flat=True)
+        )
+        books = books.filter(id__in=changed_book_ids)
+    elif page_size:
+        # Paginated mode. Pages are found by seeking past the last book of
+        # the previous page, so later pages are as fast as the first one.
+        try:
+            page_size = min(max(int(page_size), 1), BOOK_LIST_MAX_PAGE_SIZE)
+        except ValueError:
+            page_size = BOOK_LIST_PAGE_SIZE
+        if cursor:
+            position = decode_list_cursor(cursor)
+            if not position:
+                return JsonResponse(response, status=400)
+            updated, book_id = position
+            books = books.filter(
+                Q(content_updated__lt=updated)
+                | Q(content_updated=updated, id__lt=book_id)
+            )
+        books = books[: page_size + 1]
+        books = [book for book in books]
+        if len(books) > page_size:
+            books = books[:page_size]
+            response["next_cursor"] = encode_list_cursor(books[-1])
+        else:
+            response["next_cursor"] = None
+    if not cursor:
+        # Documents, contacts and styles are only sent along with the first
+        # page.
+        response["documents"] = documents_list(request)
+    response["books"] = [
+        serialize_book(book, request.user, avatars) for book in books
+    ]
+    if since:
+        response["deleted"] = sorted(
+            changed_book_ids - set(book["id"] for book in response["books"])
+        )
+    if not cursor:
+        response["contacts"] = contacts_list(request.user, avatars)
+        response["styles"] = get_styles()["styles"]
 
     return JsonResponse(response, status=status)
 
 
-def set_chapters(book, chapters, user):
-    changed = False
-    current_chapters = book.chapter_set.all().order_by("number")
-    if len(current_chapters) != len(chapters):
-        changed = True
-    else:
-        for i, cur_chap in enumerate(current_chapters):
-            if (
-                cur_chap.text_id != chapters[i]["text"]
-                or cur_chap.number != chapters[i]["number"]
-                or cur_chap.part != chapters[i]["part"]
-            ):
-                changed = True
-                break
-    if not changed:
+def styles_etag(request):
+    return get_styles()["etag"]
+
+
+@login_required
+@ajax_required
+@require_http_methods(["GET"])
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=styles_etag)
+def styles(request):
+    response = {}
+    status = 200
+    response["styles"] = get_styles()["styles"]
+    return JsonResponse(response, status=status)
+
+
+def grant_chapter_access(book, chapters, user):
+    # If the current user is the owner of a chapter-document, make sure that
+    # everyone with access to the book, including the book owner, gets at
+    # least read access to it.
+    text_ids = set(
+        Document.objects.filter(
+            id__in=[chapter.text_id for chapter in chapters], owner=user
+        ).values_list("id", flat=True)
+    )
+    if not text_ids:
         return
-    current_chapters.delete()
-    for chapter in chapters:
-        new_chapter = Chapter(
-            book=book,
-            text_id=chapter["text"],
-            number=chapter["number"],
-            part=chapter["part"],
+    user_type = ContentType.objects.get_for_model(user)
+    holders = set(
+        BookAccessRight.objects.filter(book=book).values_list(
+            "holder_type_id", "holder_id"
         )
-        new_chapter.save()
-        # If the current user is the owner of the chapter-document, make sure
-        # that everyone with access to the book gets at least read access.
-        if user == new_chapter.text.owner:
-            for bar in BookAccessRight.objects.filter(book=book):
-                if (
-                    len(
-                        new_chapter.text.accessright_set.filter(
-                            holder_id=bar.holder_id,
-                            holder_type=bar.holder_type,
-                        )
-                    )
-                    == 0
-                ):
-                    AccessRight.objects.create(
-                        document_id=new_chapter.text.id,
-                        holder_id=bar.holder_id,
-                        holder_type=bar.holder_type,
-                        rights="read",
-                    )
-            if (
-                user != book.owner
-                and len(
-                    new_chapter.text.accessright_set.filter(user=book.owner)
-                )
-                == 0
-            ):
-                AccessRight.objects.create(
-                    document_id=new_chapter.text.id,
-                    user_id=book.owner.id,
-                    rights="read",
+    )
+    holders.add((user_type.id, book.owner_id))
+    holders.discard((user_type.id, user.id))
+    existing_access_rights = set(
+        AccessRight.objects.filter(document_id__in=text_ids).values_list(
+            "document_id", "holder_type_id", "holder_id"
+        )
+    )
+    new_access_rights = [
+        AccessRight(
+            document_id=text_id,
+            holder_type_id=holder_type_id,
+            holder_id=holder_id,
+            rights="read",
+        )
+        for text_id in text_ids
+        for holder_type_id, holder_id in holders
+        if (text_id, holder_type_id, holder_id) not in existing_access_rights
+    ]
+    if not new_access_rights:
+        return
+    AccessRight.objects.bulk_create(new_access_rights, ignore_conflicts=True)
+    # Bulk operations do not send signals, so the book lists of the users
+    # that gained access to documents are marked as changed here.
+    bump_book_list_versions(
+        {
+            access_right.holder_id
+            for access_right in new_access_rights
+            if access_right.holder_type_id == user_type.id
+        }
+    )
+
+
+def set_chapters(book, chapters, user):
+    # Compare the current chapters with the requested ones by their document
+    # and only write the differences.
+    current_chapters = {}
+    removed_chapters = []
+    for chapter in book.chapter_set.all():
+        if chapter.text_id in current_chapters:
+            removed_chapters.append(chapter)
+        else:
+            current_chapters[chapter.text_id] = chapter
+    new_chapters = []
+    changed_chapters = []
+    for chapter in chapters:
+        current_chapter = current_chapters.pop(chapter["text"], None)
+        if not current_chapter:
+            new_chapters.append(
+                Chapter(
+                    book=book,
+                    text_id=chapter["text"],
+                    number=chapter["number"],
+                    part=chapter["part"],
                 )
-        book.save(force_update=True)
-    return
+            )
+        elif (
+            current_chapter.number != chapter["number"]
+            or current_chapter.part != chapter["part"]
+        ):
+            current_chapter.number = chapter["number"]
+            current_chapter.part = chapter["part"]
+            changed_chapters.append(current_chapter)
+    removed_chapters += current_chapters.values()
+    write_chapters(
+        book, new_chapters, changed_chapters, removed_chapters, user
+    )
+
+
+def patch_chapters(book, operations):
+    # Find the chapter changes requested by a list of chapter operations.
+    # Each operation adds, updates or removes the chapter of a document.
+    # Returns the new, changed and removed chapters. Invalid operations raise
+    # a ValueError before anything is written.
+    check_chapter_operations(operations)
+    current_chapters = {
+        chapter.text_id: chapter
+        for chapter in book.chapter_set.filter(
+            text_id__in=[operation["text"] for operation in operations]
+        )
+    }
+    new_chapters = {}
+    changed_chapters = {}
+    removed_chapters = {}
+    for operation in operations:
+        op = operation.get("op")
+        text_id = operation["text"]
+        chapter = new_chapters.get(text_id) or current_chapters.get(text_id)
+        if op == "remove":
+            if not chapter:
+                raise ValueError(f"No chapter for document {text_id}")
+            if new_chapters.pop(text_id, None) is None:
+                del current_chapters[text_id]
+                changed_chapters.pop(text_id, None)
+                removed_chapters[text_id] = chapter
+            continue
+        if op == "add":
+            if chapter:
+                raise ValueError(f"Chapter for document {text_id} exists")
+            chapter = Chapter(book=book, text_id=text_id)
+            new_chapters[text_id] = chapter
+        elif op == "update":
+            if not chapter:
+                raise ValueError(f"No chapter for document {text_id}")
+            if text_id not in new_chapters:
+                changed_chapters[text_id] = chapter
+        else:
+            raise ValueError(f"Unsupported operation: {op}")
+        chapter.number = operation.get("number", chapter.number)
+        chapter.part = operation.get("part", chapter.part or "")
+    if new_chapters and Document.objects.filter(
+        id__in=new_chapters.keys()
+    ).count() < len(new_chapters):
+        raise ValueError("Unknown chapter document")
+    return (
+        [*new_chapters.values()],
+        [*changed_chapters.values()],
+        [*removed_chapters.values()],
+    )
+
+
+def write_chapters(
+    book, new_chapters, changed_chapters, removed_chapters, user
+):
+    if not new_chapters and not changed_chapters and not removed_chapters:
+        return
+    if removed_chapters:
+        Chapter.objects.filter(
+            id__in=[chapter.id for chapter in removed_chapters]
+        ).delete()
+    if changed_chapters:
+        Chapter.objects.bulk_update(changed_chapters, ["number", "part"])
+    if new_chapters:
+        Chapter.objects.bulk_create(new_chapters)
+    if new_chapters:
+        grant_chapter_access(book, new_chapters, user)
+    # Bulk operations do not send signals, so the book is marked as updated
+    # once for all chapter changes.
+    book.save(force_update=True, update_fields=["updated", "content_updated"])
+
+
+def claim_book_version(book, version):
+    # Increase the version of the book if it is still at the given version.
+    # The conditional update locks the book until the end of the transaction,
+    # so that concurrent saves based on the same version cannot both succeed.
+    if not Book.objects.filter(id=book.id, version=version).update(
+        version=F("version") + 1
+    ):
+        return False
+    book.version = version + 1
+    # The update does not send signals. The new version is part of the book
+    # list of all users of the book.
+    log_book_changes(get_book_user_ids([book.id]))
+    return True
+
+
+def version_conflict(request, book_id):
+    # The current state of a book that has been changed in the meantime.
+    avatars = Avatars()
+    book = books_queryset(request.user).get(id=book_id)
+    response = {"book": serialize_book(book, request.user, avatars)}
+    # Nothing that the request has written is kept.
+    transaction.set_rollback(True)
+    return JsonResponse(response, status=409)
+
+
+def copyable_books(user, book_ids):
+    # The books with the given ids that the user owns or has access to.
+    return visible_books(user).filter(id__in=book_ids)
+
+
+def copy_books(user, copies):
+    # Copy books with their chapters. copies is a list of (book id, path)
+    # pairs. Books the user has no access to are skipped. Returns pairs of
+    # the new books and the ids of the books they are copies of.
+    books = {
+        book.id: book
+        for book in copyable_books(
+            user, [book_id for book_id, _path in copies]
+        )
+    }
+    copies = [(book_id, path) for book_id, path in copies if book_id in books]
+    if not copies:
+        return []
+    paths = free_paths(user, [path for _book_id, path in copies])
+    new_books = []
+    copies_of_book = {}
+    for (book_id, _path), path in zip(copies, paths):
+        book = copy_object(
+            books[book_id],
+            owner=user,
+            path=path,
+            content_updated=timezone.now(),
+        )
+        new_books.append((book, book_id))
+        copies_of_book.setdefault(book_id, []).append(book)
+    Book.objects.bulk_create([book for book, _book_id in new_books])
+    Chapter.objects.bulk_create(
+        [
+            copy_object(chapter, book=book)
+            for chapter in Chapter.objects.filter(
+                book_id__in=copies_of_book.keys()
+            )
+            for book in copies_of_book[chapter.book_id]
+        ]
+    )
+    # Bulk operations do not send signals.
+    log_book_changes({book.id: {user.id} for book, _book_id in new_books})
+    update_book_visibility([book.id for book, _book_id in new_books])
+    return new_books
 
 
 @login_required
 @require_POST
 @ajax_required
+@transaction.atomic
 def copy(request):
     # Copy a book
-    book_id = request.POST["id"]
-    book = Book.objects.get(id=book_id)
-    if (
-        book.owner != request.user
-        and not book.bookaccessright_set.filter(
-            holder_type__model="user", holder_id=request.user.id
-        ).exists()
-    ):
+    book_id = int(request.POST["id"])
+    new_books = copy_books(request.user, [(book_id, request.POST["path"])])
+    if not new_books:
         return JsonResponse({}, status=405)
-    path = request.POST["path"]
-    if len(path):
-        counter = 0
-        base_path = path
-        while (
-            Book.objects.filter(owner=request.user, path=path).first()
-            or BookAccessRight.objects.filter(
-                holder_id=request.user.id, holder_type__model="user", path=path
-            ).first()
-        ):
-            counter += 1
-            path = f"{base_path} {counter}"
+    book, _book_id = new_books[0]
     response = {}
     status = 201
-    book.id = None
-    book.owner = request.user
-    book.path = path
-    book.save()
-    # Copy chapters
-    for chapter in Chapter.objects.filter(book_id=book_id):
-        chapter.id = None
-        chapter.book_id = book.id
-        chapter.save()
     response["id"] = book.id
     response["path"] = book.path
     return JsonResponse(response, status=status)
 
 
+@login_required
+@require_POST
+@ajax_required
+@transaction.atomic
+def copy_bulk(request):
+    # Copy several books at once. Books the user has no access to are
+    # reported as not copied.
+    response = {}
+    try:
+        copies = json.loads(request.POST["books"])
+        check_book_copies(copies)
+    except (KeyError, ValueError) as error:
+        response["error"] = str(error)
+        return JsonResponse(response, status=400)
+    new_books = copy_books(
+        request.user, [(copy["id"], copy["path"]) for copy in copies]
+    )
+    response["books"] = [
+        {"id": book.id, "path": book.path, "original_id": book_id}
+        for book, book_id in new_books
+    ]
+    copied_ids = set(book_id for _book, book_id in new_books)
+    response["results"] = [
+        {"id": copy["id"], "copied": copy["id"] in copied_ids}
+        for copy in copies
+    ]
+    status = 201
+    return JsonResponse(response, status=status)
+
+
+@login_required
+@require_POST
+@ajax_required
+def copy_deep(request):
+    # Start a copy of a book including its chapter documents. The copy is
+    # made in the background, its progress can be followed with copy_job.
+    book = copyable_books(request.user, [int(request.POST["id"])]).first()
+    if not book:
+        return JsonResponse({}, status=405)
+    job = BookCopyJob.objects.create(
+        user=request.user, book=book, path=request.POST["path"]
+    )
+    response = {"job": job.id}
+    status = 202
+    return JsonResponse(response, status=status)
+
+
+@login_required
+@ajax_required
+@require_http_methods(["GET"])
+def copy_job(request, job_id):
+    job = BookCopyJob.objects.filter(id=job_id, user=request.user).first()
+    if not job:
+        return JsonResponse({}, status=404)
+    response = {
+        "status": job.status,
+        "chapters_total": job.chapters_total,
+        "chapters_copied": job.chapters_copied,
+    }
+    book = books_queryset(request.user).filter(id=job.new_book_id).first()
+    if book:
+        response["id"] = book.id
+        response["path"] = book.path
+        # The copy has new chapter documents.
+        response["book"] = serialize_book(book, request.user, Avatars())
+    status = 200
+    return JsonResponse(response, status=status)
+
+
 @login_required
 @require_POST
 @ajax_required
@@ -310,8 +765,8 @@ def save_odt_template(request):
     response = {}
     status = 403
     book_id = int(request.POST["id"])
-    book = Book.objects.get(id=book_id)
-    if book.owner == request.user:
+    if is_book_owner(request, book_id):
+        book = Book.objects.get(id=book_id)
         book.odt_template = request.FILES["file"]
         book.save(update_fields=["odt_template"])
         response["odt_template"] = book.odt_template.url
@@ -326,8 +781,8 @@ def save_docx_template(request):
     response = {}
     status = 403
     book_id = int(request.POST["id"])
-    book = Book.objects.get(id=book_id)
-    if book.owner == request.user:
+    if is_book_owner(request, book_id):
+        book = Book.objects.get(id=book_id)
         book.docx_template = request.FILES["file"]
         book.save(update_fields=["docx_template"])
         response["docx_template"] = book.docx_template.url
@@ -338,6 +793,7 @@ def save_docx_template(request):
 @login_required
 @require_POST
 @ajax_required
+@transaction.atomic
 def save(request):
     response = {}
     status = 403
@@ -351,21 +807,19 @@ def save(request):
         book.owner = request.user
         book.path = book_obj["path"]
         has_book_write_access = True
-    else:
+    elif get_book_rights(request, book_obj["id"]) == "write":
         book = Book.objects.get(id=book_obj["id"])
-        if book.owner == request.user:
-            has_book_write_access = True
+        has_book_write_access = True
+        if is_book_owner(request, book.id):
             book.path = book_obj["path"]
         else:
-            access_right = book.bookaccessright_set.filter(
-                holder_type__model="user",
-                holder_id=request.user.id,
-                rights="write",
-            ).first()
-            if access_right:
-                has_book_write_access = True
-                access_right.path = book_obj["path"]
-                access_right.save()
+            access_right = book.bookaccessright_set.get(
+                holder_type__model="user", holder_id=request.user.id
+            )
+            access_right.path = book_obj["path"]
+            access_right.save()
+    else:
+        return JsonResponse(response, status=status)
     has_coverimage_access = False
     if "docx_template" not in book_obj:
         # If the docx_template is not in the book object, we remove it in the database.
@@ -390,32 +844,143 @@ def save(request):
         book.cover_image_id = book_obj["cover_image"]
         has_coverimage_access = True
     if has_book_write_access and has_coverimage_access:
-        book.metadata = book_obj["metadata"]
-        book.settings = book_obj["settings"]
-        book.title = book_obj["title"]
-        book.save()
+        version = book_obj.get("version", book.version)
+        with defer_book_changes():
+            claimed = not book.id or claim_book_version(book, version)
+            if claimed:
+                book.metadata = book_obj["metadata"]
+                book.settings = book_obj["settings"]
+                book.title = book_obj["title"]
+                book.save()
+                set_chapters(book, chapters, request.user)
+        if not claimed:
+            return version_conflict(request, book.id)
         status = 201
         response["id"] = book.id
+        response["version"] = book.version
         response["added"] = time.mktime(book.added.utctimetuple())
-        response["updated"] = time.mktime(book.updated.utctimetuple())
-        set_chapters(book, chapters, request.user)
+        response["updated"] = time.mktime(book.content_updated.utctimetuple())
+    return JsonResponse(response, status=status)
+
+
+@login_required
+@require_POST
+@ajax_required
+@transaction.atomic
+def patch(request):
+    # Save only the given changes of a book. metadata and settings are
+    # changed with JSON patch operations, chapters with chapter operations.
+    response = {}
+    status = 403
+    book_id = int(request.POST["id"])
+    changes = json.loads(request.POST["patch"])
+    if get_book_rights(request, book_id) != "write":
+        return JsonResponse(response, status=status)
+    book = Book.objects.get(id=book_id)
+    update_fields = []
+    try:
+        if not isinstance(changes, dict):
+            raise ValueError("The patch must be an object")
+        for field in ("title", "path"):
+            if not isinstance(changes.get(field, ""), str):
+                raise ValueError(f"{field} must be a string")
+        for field in ("version", "cover_image"):
+            if not isinstance(changes.get(field) or 0, int):
+                raise ValueError(f"{field} must be a number")
+        if "title" in changes:
+            book.title = changes["title"]
+            update_fields.append("title")
+        for field in ("metadata", "settings"):
+            if field in changes:
+                setattr(
+                    book,
+                    field,
+                    apply_json_patch(getattr(book, field), changes[field]),
+                )
+                update_fields.append(field)
+        for field in ("docx_template", "odt_template"):
+            # Templates are uploaded separately, they can only be removed.
+            if field in changes:
+                if changes[field] is not None:
+                    raise ValueError(f"{field} can only be removed")
+                setattr(book, field, None)
+                update_fields.append(field)
+        chapter_changes = patch_chapters(book, changes.get("chapters", []))
+    except ValueError as error:
+        response["error"] = str(error)
+        return JsonResponse(response, status=400)
+    if "cover_image" in changes:
+        image_id = changes["cover_image"] or None
+        if (
+            image_id is not None
+            and image_id != book.cover_image_id
+            and not UserImage.objects.filter(
+                owner=request.user, image_id=image_id
+            ).exists()
+        ):
+            return JsonResponse(response, status=status)
+        book.cover_image_id = image_id
+        update_fields.append("cover_image")
+    version = changes.get("version", book.version)
+    # The path is that of the user, so it is no change of the book that
+    # could conflict with others.
+    book_changed = bool(update_fields) or any(chapter_changes)
+    with defer_book_changes():
+        claimed = not book_changed or claim_book_version(book, version)
+        if claimed:
+            if "path" in changes:
+                if is_book_owner(request, book_id):
+                    book.path = changes["path"]
+                    update_fields.append("path")
+                else:
+                    access_right = book.bookaccessright_set.get(
+                        holder_type__model="user", holder_id=request.user.id
+                    )
+                    access_right.path = changes["path"]
+                    access_right.save()
+            if update_fields:
+                book.save(
+                    update_fields=update_fields
+                    + ["updated", "content_updated"]
+                )
+            write_chapters(book, *chapter_changes, request.user)
+    if not claimed:
+        return version_conflict(request, book.id)
+    status = 200
+    response["id"] = book.id
+    response["version"] = book.version
+    response["updated"] = time.mktime(book.content_updated.utctimetuple())
     return JsonResponse(response, status=status)
 
 
 @login_required
 @require_POST
 @ajax_required
+@transaction.atomic
 def delete(request):
+    # Delete the books with the given ids that belong to the user. The cover
+    # images that are no longer used are deleted as well.
     response = {}
     status = 405
-    book_id = int(request.POST["id"])
-    book = Book.objects.filter(pk=book_id, owner=request.user).first()
-    if book:
-        image = book.cover_image
-        book.delete()
-        if image and image.is_deletable():
-            image.delete()
+    book_ids = [int(book_id) for book_id in request.POST.getlist("ids[]")]
+    if "id" in request.POST:
+        book_ids.append(int(request.POST["id"]))
+    books = Book.objects.filter(id__in=book_ids, owner=request.user)
+    deleted_ids = set()
+    image_ids = set()
+    for book_id, image_id in books.values_list("id", "cover_image_id"):
+        deleted_ids.add(book_id)
+        if image_id:
+            image_ids.add(image_id)
+    if deleted_ids:
+        with defer_book_changes():
+            books.delete()
+        delete_unused_images(image_ids)
         status = 200
+    response["results"] = [
+        {"id": book_id, "deleted": book_id in deleted_ids}
+        for book_id in book_ids
+    ]
     return JsonResponse(response, status=status)
 
 
@@ -427,10 +992,10 @@ def move(request):
     status = 200
     book_id = int(request.POST["id"])
     path = request.POST["path"]
-    book = Book.objects.filter(pk=book_id).first()
-    if not book:
+    if not get_book_rights(request, book_id):
         response["done"] = False
-    elif book.owner == request.user:
+    elif is_book_owner(request, book_id):
+        book = Book.objects.get(pk=book_id)
         book.path = path
         book.save(
             update_fields=[
@@ -439,124 +1004,255 @@ def move(request):
         )
         response["done"] = True
     else:
-        access_right = BookAccessRight.objects.filter(
-            book=book, holder_id=request.user.id, holder_type__model="user"
-        ).first()
-        if not access_right:
-            response["done"] = False
-        else:
-            access_right.path = path
-            access_right.save()
-            response["done"] = True
+        access_right = BookAccessRight.objects.get(
+            book_id=book_id,
+            holder_id=request.user.id,
+            holder_type__model="user",
+        )
+        access_right.path = path
+        access_right.save()
+        response["done"] = True
     return JsonResponse(response, status=status)
 
 
 @login_required
-@require_POST
 @ajax_required
+@require_POST
 @transaction.atomic
-def save_access_rights(request):
-    User = get_user_model()
+def move_folder(request):
+    # Move all books in a folder, including those in its subfolders, by
+    # replacing the beginning of their paths.
     response = {}
-    book_ids = json.loads(request.POST["book_ids"])
-    rights = json.loads(request.POST["access_rights"])
-    for book_id in book_ids:
-        book = Book.objects.filter(pk=book_id, owner=request.user).first()
-        if not book:
-            continue
-        for right in rights:
-            if right["rights"] == "delete":
+    old_path = request.POST["old_path"]
+    new_path = request.POST["new_path"]
+    if not (
+        old_path.startswith("/")
+        and old_path.endswith("/")
+        and new_path.startswith("/")
+        and new_path.endswith("/")
+    ):
+        return JsonResponse(response, status=400)
+    moved_path = Concat(
+        Value(new_path), Substr(normalized_path("path"), len(old_path) + 1)
+    )
+    visibilities = in_folder(
+        BookVisibility.objects.filter(user=request.user), "path", old_path
+    )
+    book_ids = set(visibilities.values_list("book_id", flat=True))
+    response["books"] = in_folder(
+        Book.objects.filter(owner=request.user), "path", old_path
+    ).update(path=moved_path)
+    response["access_rights"] = in_folder(
+        user_access_rights(request.user), "path", old_path
+    ).update(path=moved_path)
+    visibilities.update(path=moved_path)
+    # Updates do not send signals.
+    log_book_changes({book_id: {request.user.id} for book_id in book_ids})
+    status = 200
+    return JsonResponse(response, status=status)
+
+
+@login_required
+@ajax_required
+@require_http_methods(["GET"])
+def folders(request):
+    # The subfolders of a folder in the book list with the number of books
+    # in each of them, including those in further subfolders, and the time
+    # of their latest update.
+    response = {}
+    folder = request.GET.get("path", "/")
+    if not (folder.startswith("/") and folder.endswith("/")):
+        return JsonResponse(response, status=400)
+    response["path"] = folder
+    response["folders"] = [
+        {
+            "name": subfolder["name"],
+            "path": f"{folder}{subfolder['name']}/",
+            "count": subfolder["count"],
+            "updated": time.mktime(subfolder["updated"].utctimetuple()),
+        }
+        for subfolder in subfolders(
+            BookVisibility.objects.filter(user=request.user),
+            "path",
+            "book__content_updated",
+            folder,
+        ).order_by("name")
+    ]
+    status = 200
+    return JsonResponse(response, status=status)
+
+
+def share_books(books, rights, user):
+    # Apply the requested access rights to all books at once. Everything that
+    # is needed is loaded upfront, so the number of queries does not depend
+    # on the number of books or holders. Returns the changes that the holders
+    # are to be notified about.
+    requested_rights = {}
+    for right in rights:
+        holder_type = ContentType.objects.get_by_natural_key(
+            "user", right["holder"]["type"]
+        )
+        requested_rights[(holder_type.id, right["holder"]["id"])] = right[
+            "rights"
+        ]
+    if not books or not requested_rights:
+        return []
+    user_type = ContentType.objects.get_for_model(user)
+    existing_access_rights = {
+        (ar.book_id, ar.holder_type_id, ar.holder_id): ar
+        for ar in BookAccessRight.objects.filter(
+            book_id__in=books.keys(),
+            holder_id__in={
+                holder_id for _type_id, holder_id in requested_rights
+            },
+        )
+    }
+    holders = get_holders(
+        [
+            BookAccessRight(holder_type_id=holder_type_id, holder_id=holder_id)
+            for (holder_type_id, holder_id), rights in requested_rights.items()
+            if rights != "delete"
+        ]
+    )
+    deleted_access_rights = []
+    changed_access_rights = []
+    new_access_rights = []
+    shared_holders = set()
+    notifications = []
+    for book in books.values():
+        # Make the shared path "/filename" or ""
+        path = "/%(last_path_part)s" % {
+            "last_path_part": book.path.split("/").pop()
+        }
+        if len(path) == 1:
+            path = ""
+        for (holder_type_id, holder_id), rights in requested_rights.items():
+            access_right = existing_access_rights.get(
+                (book.id, holder_type_id, holder_id)
+            )
+            if rights == "delete":
                 # Status 'delete' means the access right is marked for
                 # deletion.
-                BookAccessRight.objects.filter(
-                    **{
-                        "book_id": book_id,
-                        "holder_id": right["holder"]["id"],
-                        "holder_type__model": right["holder"]["type"],
-                    }
-                ).delete()
-            else:
-                owner = request.user.readable_name
-                link = HttpRequest.build_absolute_uri(request, "/books/")
-                access_right = BookAccessRight.objects.filter(
-                    **{
-                        "book_id": book_id,
-                        "holder_id": right["holder"]["id"],
-                        "holder_type__model": right["holder"]["type"],
-                    }
-                ).first()
-                book_title = book.title
                 if access_right:
-                    if access_right.rights != right["rights"]:
-                        access_right.rights = right["rights"]
-                        if right["holder"]["type"] == "user":
-                            collaborator = User.objects.get(
-                                id=right["holder"]["id"]
-                            )
-                            collaborator_name = collaborator.readable_name
-                            collaborator_email = collaborator.email
-                            emails.send_share_notification(
-                                book_title,
-                                owner,
-                                link,
-                                collaborator_name,
-                                collaborator_email,
-                                right["rights"],
-                                True,
-                            )
-                else:
-                    # Make the shared path "/filename" or ""
-                    path = "/%(last_path_part)s" % {
-                        "last_path_part": book.path.split("/").pop()
-                    }
-                    if len(path) == 1:
-                        path = ""
-                    if right["holder"]["type"] == "userinvite":
-                        holder = UserInvite.objects.filter(
-                            id=right["holder"]["id"]
-                        ).first()
-                    else:
-                        holder = User.objects.filter(
-                            id=right["holder"]["id"]
-                        ).first()
-                    if not holder:
-                        continue
-                    access_right = BookAccessRight.objects.create(
-                        book_id=book_id,
-                        holder_obj=holder,
-                        rights=right["rights"],
+                    deleted_access_rights.append(access_right.id)
+                continue
+            holder = holders.get((holder_type_id, holder_id))
+            if access_right:
+                if access_right.rights != rights:
+                    access_right.rights = rights
+                    changed_access_rights.append(access_right)
+                    if holder_type_id == user_type.id and holder:
+                        notifications.append((book, holder, rights, True))
+            elif not holder:
+                continue
+            else:
+                new_access_rights.append(
+                    BookAccessRight(
+                        book_id=book.id,
+                        holder_type_id=holder_type_id,
+                        holder_id=holder_id,
+                        rights=rights,
                         path=path,
                     )
-                    if right["holder"]["id"] == "user":
-                        collaborator_name = holder.readable_name
-                        collaborator_email = holder.email
-                        emails.send_share_notification(
-                            book_title,
-                            owner,
-                            link,
-                            collaborator_name,
-                            collaborator_email,
-                            right["rights"],
-                            False,
-                        )
-                access_right.save()
-                for text in book.chapters.all():
-                    # If one shares a book with another user and that user
-                    # has no access rights on the chapters that belong to
-                    # the current user, give read access to the chapter
-                    # documents to the collaborator.
-                    if (
-                        text.owner == request.user
-                        and not text.accessright_set.filter(
-                            holder_type__model=access_right.holder_type.model,
-                            holder_id=access_right.holder_id,
-                        ).first()
-                    ):
-                        AccessRight.objects.create(
-                            document_id=text.id,
-                            holder_id=access_right.holder_id,
-                            holder_type=access_right.holder_type,
-                            rights="read",
-                        )
+                )
+                if holder_type_id == user_type.id:
+                    notifications.append((book, holder, rights, False))
+            shared_holders.add((book.id, holder_type_id, holder_id))
+    if deleted_access_rights:
+        BookAccessRight.objects.filter(id__in=deleted_access_rights).delete()
+    if changed_access_rights:
+        BookAccessRight.objects.bulk_update(changed_access_rights, ["rights"])
+    if new_access_rights:
+        BookAccessRight.objects.bulk_create(new_access_rights)
+    # Bulk operations do not send signals, so the changes of the book lists
+    # of the holders are logged here.
+    changed_user_ids = defaultdict(set)
+    for access_right in changed_access_rights + new_access_rights:
+        if access_right.holder_type_id == user_type.id:
+            changed_user_ids[access_right.book_id].add(access_right.holder_id)
+    log_book_changes(changed_user_ids)
+    update_user_book_visibility(changed_user_ids)
+    share_chapters(shared_holders, user)
+    return notifications
+
+
+def share_chapters(shared_holders, user):
+    # If one shares a book with another user and that user has no access
+    # rights on the chapters that belong to the current user, give read
+    # access to the chapter documents to the collaborator.
+    book_holders = defaultdict(set)
+    for book_id, holder_type_id, holder_id in shared_holders:
+        book_holders[book_id].add((holder_type_id, holder_id))
+    text_ids = defaultdict(set)
+    for book_id, text_id in Chapter.objects.filter(
+        book_id__in=book_holders.keys(), text__owner=user
+    ).values_list("book_id", "text_id"):
+        text_ids[text_id].add(book_id)
+    if not text_ids:
+        return
+    existing_access_rights = set(
+        AccessRight.objects.filter(
+            document_id__in=text_ids.keys(),
+            holder_id__in={
+                holder_id for _book_id, _type_id, holder_id in shared_holders
+            },
+        ).values_list("document_id", "holder_type_id", "holder_id")
+    )
+    new_access_rights = {}
+    for text_id, book_ids in text_ids.items():
+        for book_id in book_ids:
+            for holder_type_id, holder_id in book_holders[book_id]:
+                key = (text_id, holder_type_id, holder_id)
+                if key in existing_access_rights:
+                    continue
+                new_access_rights[key] = AccessRight(
+                    document_id=text_id,
+                    holder_type_id=holder_type_id,
+                    holder_id=holder_id,
+                    rights="read",
+                )
+    if not new_access_rights:
+        return
+    AccessRight.objects.bulk_create(
+        new_access_rights.values(), ignore_conflicts=True
+    )
+    user_type = ContentType.objects.get_for_model(user)
+    bump_book_list_versions(
+        {
+            holder_id
+            for _text_id, holder_type_id, holder_id in new_access_rights
+            if holder_type_id == user_type.id
+        }
+    )
+
+
+@login_required
+@require_POST
+@ajax_required
+@transaction.atomic
+def save_access_rights(request):
+    response = {}
+    try:
+        book_ids = json.loads(request.POST["book_ids"])
+        rights = json.loads(request.POST["access_rights"])
+        if not all(isinstance(book_id, int) for book_id in book_ids):
+            raise ValueError("Book ids must be numbers")
+        check_access_rights(rights)
+    except (KeyError, TypeError, ValueError) as error:
+        response["error"] = str(error)
+        return JsonResponse(response, status=400)
+    books = {
+        book.id: book
+        for book in Book.objects.filter(
+            pk__in=book_ids, owner=request.user
+        ).only("id", "title", "path")
+    }
+    with defer_book_changes():
+        notifications = share_books(books, rights, request.user)
+    owner = request.user.readable_name
+    link = HttpRequest.build_absolute_uri(request, "/books/")
+    emails.queue_mails(
+        emails.share_notification_emails(owner, link, notifications)
+    )
     status = 201
     return JsonResponse(response, status=status)